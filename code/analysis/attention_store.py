@@ -0,0 +1,124 @@
+import json
+import os
+import numpy as np
+
+
+class AttentionStore:
+    """
+    Compact binary container for cross-attention weights.
+
+    The weights of each sentence are a float16 array of shape
+    (layers, heads, target tokens, source tokens), appended to fixed-size chunk
+    files (chunk_00000.f16, ...). index.jsonl maps (document, sentence) to the
+    chunk, offset and shape of the array, and stores the source/target tokens
+    so that heatmaps can be labelled. Reading memory-maps the chunk and returns
+    a view, so only the requested sentence is read from disk.
+
+        store = AttentionStore("attention/concat", mode="w", layers=[5], heads=None)
+        store.add(doc, sent, attention, src_tokens, tgt_tokens)
+        store.close()
+
+        store = AttentionStore("attention/concat")
+        attention, src_tokens, tgt_tokens = store.get(doc, sent, heads=[0, 3])
+    """
+
+    def __init__(self, path, mode="r", layers=None, heads=None, chunk_bytes=256 * 2**20):
+        self.path = path
+        self.mode = mode
+        # Layers and heads kept when writing (None: all of them)
+        self.layers = layers
+        self.heads = heads
+        self.chunk_bytes = chunk_bytes
+        self._index = {}
+        self._memmaps = {}
+
+        index_file = os.path.join(path, "index.jsonl")
+        if mode == "w":
+            os.makedirs(path, exist_ok=True)
+        if os.path.exists(index_file):
+            with open(index_file, "r") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self._index[entry["document"], entry["sentence"]] = entry
+
+        if mode == "w":
+            # Appending to an existing store continues after its last chunk
+            self._chunk = max((entry["chunk"] for entry in self._index.values()), default=0)
+            self._data_file = open(self._chunk_path(self._chunk), "ab")
+            self._index_file = open(index_file, "a")
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.path, f"chunk_{chunk:05d}.f16")
+
+    def add(self, document, sentence, attention, src_tokens=None, tgt_tokens=None):
+        """Store the (layers, heads, target, source) attention of one sentence."""
+        layers = self.layers if self.layers is not None else list(range(attention.shape[0]))
+        heads = self.heads if self.heads is not None else list(range(attention.shape[1]))
+        attention = np.ascontiguousarray(np.asarray(attention)[layers][:, heads], dtype=np.float16)
+
+        # Start a new chunk when the current one is full
+        if self._data_file.tell() > 0 and self._data_file.tell() + attention.nbytes > self.chunk_bytes:
+            self._data_file.close()
+            self._chunk += 1
+            self._data_file = open(self._chunk_path(self._chunk), "ab")
+
+        entry = {
+            "document": document,
+            "sentence": sentence,
+            "chunk": self._chunk,
+            # Offset in float16 elements, as used by the memmap
+            "offset": self._data_file.tell() // 2,
+            "shape": list(attention.shape),
+            "layers": layers,
+            "heads": heads,
+            "src_tokens": src_tokens,
+            "tgt_tokens": tgt_tokens,
+        }
+        self._data_file.write(attention.tobytes())
+        self._index_file.write(json.dumps(entry) + "\n")
+        self._index[document, sentence] = entry
+
+    def keys(self):
+        return sorted(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, document, sentence, layers=None, heads=None):
+        """
+        Return (attention, src_tokens, tgt_tokens) for one sentence. layers and heads
+        select among the stored ones, using the original model layer/head numbers.
+        """
+        entry = self._index[document, sentence]
+        chunk = entry["chunk"]
+        if chunk not in self._memmaps:
+            if self.mode == "w":
+                self._data_file.flush()
+            self._memmaps[chunk] = np.memmap(self._chunk_path(chunk), dtype=np.float16, mode="r")
+        data = self._memmaps[chunk]
+        size = int(np.prod(entry["shape"]))
+        if entry["offset"] + size > data.shape[0]:
+            # The chunk grew since it was mapped
+            data = self._memmaps[chunk] = np.memmap(self._chunk_path(chunk), dtype=np.float16, mode="r")
+        attention = data[entry["offset"]:entry["offset"] + size].reshape(entry["shape"])
+
+        if layers is not None:
+            attention = attention[[entry["layers"].index(layer) for layer in layers]]
+        if heads is not None:
+            attention = attention[:, [entry["heads"].index(head) for head in heads]]
+        return attention, entry["src_tokens"], entry["tgt_tokens"]
+
+    def close(self):
+        if self.mode == "w":
+            self._data_file.close()
+            self._index_file.close()
+        self._memmaps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,25 +1,856 @@
+import argparse
+import hashlib
+import multiprocessing as mp
+import os
+import threading
+import time
+from collections import OrderedDict
 import torch
 import csv
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM, LogitsProcessor, LogitsProcessorList
+from translation_cache import TranslationCache, normalize_source
+from attention_store import AttentionStore
+from tokenization_cache import file_hash, tokenize_file, TOKENIZATION_CACHE_DIR
+
+
+class ModelRegistry:
+    """
+    Process-level cache of (tokenizer, model) pairs.
+
+    Each model is loaded once, switched to eval mode and frozen (no gradients).
+    When max_memory_bytes is set, the least-recently-used models are evicted
+    until the weights of the loaded models fit under the cap again.
+    fp32, int8-quantized and ONNX Runtime variants of the same model are separate entries.
+    """
+
+    def __init__(self, max_memory_bytes=None):
+        self.max_memory_bytes = max_memory_bytes
+        self._entries = OrderedDict()   # (model_name, quantized, backend) -> (tokenizer, model, n_bytes)
+        self._lock = threading.RLock()
+
+    def get(self, model_name, quantized=False, backend="torch"):
+        key = (model_name, quantized, backend)
+        with self._lock:
+            if key in self._entries:
+                # Mark the model as the most recently used one
+                self._entries.move_to_end(key)
+                tokenizer, model, _ = self._entries[key]
+                return tokenizer, model
+
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            if backend == "onnx":
+                if quantized:
+                    raise ValueError("The int8 mode is only available with the torch backend")
+                model, n_bytes = load_onnx_model(model_name)
+            elif backend == "torch":
+                if quantized:
+                    model = load_quantized_model(model_name)
+                else:
+                    model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+                model.eval()
+                for param in model.parameters():
+                    param.requires_grad_(False)
+                n_bytes = model_memory_bytes(model)
+            else:
+                raise ValueError(f"Unknown backend '{backend}' (expected 'torch' or 'onnx')")
+
+            self._entries[key] = (tokenizer, model, n_bytes)
+            self._evict()
+            return tokenizer, model
+
+    def _evict(self):
+        if self.max_memory_bytes is None:
+            return
+        # Always keep the model that was just loaded, even if it alone exceeds the cap
+        while len(self._entries) > 1 and self.memory_bytes() > self.max_memory_bytes:
+            self._entries.popitem(last=False)
+
+    def memory_bytes(self):
+        with self._lock:
+            return sum(n_bytes for _, _, n_bytes in self._entries.values())
+
+    def release(self, model_name=None, quantized=False, backend="torch"):
+        """Drop one model (or every model when model_name is None) from the registry."""
+        with self._lock:
+            if model_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((model_name, quantized, backend), None)
+
+    def __contains__(self, model_name):
+        return any(key[0] == model_name for key in self._entries)
+
+
+def _tensor_bytes(value, seen):
+    # Packed int8 weights of quantized linear layers are stored as (weight, bias) tuples
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v, seen) for v in value)
+    if not isinstance(value, torch.Tensor):
+        return 0
+    # Shared tensors (e.g. tied Marian embeddings) are counted once
+    key = (value.data_ptr(), value.numel())
+    if key in seen:
+        return 0
+    seen.add(key)
+    return value.numel() * value.element_size()
+
+
+def model_memory_bytes(model):
+    # Size of the weights and buffers, which dominates the resident size of a Marian model
+    seen = set()
+    return sum(_tensor_bytes(value, seen) for value in model.state_dict().values())
+
+
+# Quantized models are cached here so that quantization runs only once per model
+QUANTIZED_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ca-nmt", "quantized")
+
+
+def model_revision(model_name):
+    """
+    Identifies the fp32 weights behind model_name: a hash of the config and weight files
+    of a local directory, or the resolved commit of a hub model.
+    """
+    sha = hashlib.sha256()
+    if os.path.isdir(model_name):
+        for file_name in sorted(os.listdir(model_name)):
+            if file_name == "config.json" or file_name.endswith((".bin", ".safetensors")):
+                sha.update(file_name.encode("utf-8"))
+                sha.update(file_hash(os.path.join(model_name, file_name)).encode("utf-8"))
+        return sha.hexdigest()[:16]
+    config = AutoConfig.from_pretrained(model_name)
+    revision = getattr(config, "_commit_hash", None)
+    if revision is None:
+        # No commit known (e.g. an old transformers): fall back to the config itself
+        sha.update(config.to_json_string().encode("utf-8"))
+        return sha.hexdigest()[:16]
+    return revision[:16]
+
+
+def quantized_model_path(model_name, cache_dir=None, revision=None):
+    cache_dir = cache_dir or QUANTIZED_CACHE_DIR
+    revision = revision or model_revision(model_name)
+    # The pickled modules depend on the fp32 weights and the torch version, so both are part of the file name
+    file_name = "{}-{}-int8-torch{}.pt".format(model_name.strip("/").replace("/", "--"), revision, torch.__version__)
+    return os.path.join(cache_dir, file_name)
+
+
+def load_quantized_model(model_name, cache_dir=None):
+    """
+    Return the model with every nn.Linear dynamically quantized to int8.
+    The quantized model is saved on disk on first use and loaded from there afterwards,
+    as long as the fp32 weights it was built from have not changed.
+    """
+    path = quantized_model_path(model_name, cache_dir)
+    if os.path.exists(path):
+        # The file holds pickled modules, not only tensors
+        return torch.load(path, weights_only=False)
 
-def translate_and_convert_to_csv(input_file, output_csv, model_name="Helsinki-NLP/opus-mt-en-de", input_delimiter='\t'):
-    # Step 1: Load the pre-trained model and tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
     model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+    model.eval()
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that an interrupted save never leaves a broken cache entry
+    torch.save(model, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return model
+
+
+# ONNX exports (encoder, decoder and decoder-with-past) are cached here
+ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ca-nmt", "onnx")
+
+
+def onnx_model_path(model_name, cache_dir, optimum_version, onnxruntime_version, revision=None):
+    cache_dir = cache_dir or ONNX_CACHE_DIR
+    revision = revision or model_revision(model_name)
+    # The export depends on the fp32 weights and on the exporter and runtime versions, so all of them are part of the directory name
+    directory_name = "{}-{}-optimum{}-ort{}".format(model_name.strip("/").replace("/", "--"), revision, optimum_version, onnxruntime_version)
+    return os.path.join(cache_dir, directory_name)
+
+
+def load_onnx_model(model_name, cache_dir=None):
+    """
+    Return an ONNX Runtime version of the model and the size of its ONNX files.
+
+    The encoder, decoder and decoder-with-past are exported to ONNX on first use and
+    saved under cache_dir, once per model revision and optimum/onnxruntime version.
+    The returned model has the usual generate() (greedy and beam search) but runs
+    every forward pass in ONNX Runtime.
+    """
+    # optimum and onnxruntime are only needed for this backend
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    from optimum.version import __version__ as optimum_version
+
+    path = onnx_model_path(model_name, cache_dir, optimum_version, onnxruntime.__version__)
+    if os.path.exists(os.path.join(path, "config.json")):
+        model = ORTModelForSeq2SeqLM.from_pretrained(path, use_cache=True)
+    else:
+        model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True, use_cache=True)
+        model.save_pretrained(path)
+
+    n_bytes = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.endswith((".onnx", ".onnx_data")))
+    return model, n_bytes
+
+
+# Shared by every translation call made in this process
+MODEL_REGISTRY = ModelRegistry()
+
+
+def load_model(model_name, registry=None, quantized=False, backend="torch"):
+    """Return the (tokenizer, model) pair for model_name, loading it only on first use."""
+    registry = registry if registry is not None else MODEL_REGISTRY
+    return registry.get(model_name, quantized=quantized, backend=backend)
+
+
+def length_bucketed_batches(lengths, batch_size=None, max_tokens=None):
+    """
+    Group sentence indices into batches of similar length so that padding is minimal.
+    Returns a list of index lists; with batch_size=None everything goes in one batch.
+    With max_tokens, a batch is also closed before its padded size
+    (number of sentences x longest sentence) would exceed max_tokens.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    if not order:
+        return []
+    if batch_size is None and max_tokens is None:
+        return [order]
+
+    batches, current = [], []
+    for i in order:
+        # Sentences come in increasing length, so lengths[i] is the padded length of the batch
+        too_many = batch_size is not None and len(current) >= batch_size
+        too_large = max_tokens is not None and (len(current) + 1) * lengths[i] > max_tokens
+        if current and (too_many or too_large):
+            batches.append(current)
+            current = []
+        current.append(i)
+    batches.append(current)
+    return batches
+
+
+def max_target_tokens(model, max_new_tokens=512):
+    """
+    max_new_tokens capped to what the decoder can embed: Marian models have learned (or
+    fixed-size) position embeddings, and the decoder start token takes the first position.
+    """
+    max_positions = getattr(model.config, "max_position_embeddings", None)
+    return min(max_new_tokens, max_positions - 1) if max_positions else max_new_tokens
+
+
+def beam_size(model, num_beams=None):
+    # num_beams=None keeps the beam search setting the model ships with (opus-mt models: 4 or 6 beams)
+    return num_beams if num_beams is not None else model.generation_config.num_beams
+
+
+def beam_kwargs(num_beams=None):
+    # num_beams is only passed to generate() when it overrides the model's generation config
+    return {} if num_beams is None else {"num_beams": num_beams}
+
+
+def generate_batch(sentences, tokenizer, model, max_new_tokens=512, num_beams=None):
+    # Tokenize and generate one batch of sentences, returning the output token ids
+    tokenized_inputs = tokenizer(sentences, return_tensors="pt", padding=True, max_length=512, truncation=True)
+    with torch.no_grad():
+        return model.generate(**tokenized_inputs, max_new_tokens=max_target_tokens(model, max_new_tokens), **beam_kwargs(num_beams))
+
+
+def generate_from_ids(input_ids, attention_mask, model, max_new_tokens=512, num_beams=None, **generate_kwargs):
+    # Generate from already tokenized and padded inputs (numpy arrays or tensors)
+    input_ids = torch.as_tensor(input_ids, dtype=torch.long)
+    attention_mask = torch.as_tensor(attention_mask, dtype=torch.long)
+    with torch.no_grad():
+        return model.generate(input_ids=input_ids, attention_mask=attention_mask, max_new_tokens=max_target_tokens(model, max_new_tokens), **beam_kwargs(num_beams), **generate_kwargs)
+
+
+def run_batches(lengths, run_batch, batch_size=None, max_tokens=None, batcher=None):
+    """
+    Call run_batch(indices) -> outputs on length-bucketed batches and return the outputs in input order.
+    With an AdaptiveBatcher, the batches are sized by its memory budget instead.
+    """
+    if batcher is not None:
+        return batcher.run(lengths, run_batch)
+    outputs = [None] * len(lengths)
+    for batch in length_bucketed_batches(lengths, batch_size, max_tokens):
+        for i, output in zip(batch, run_batch(batch)):
+            outputs[i] = output
+    return outputs
+
+
+def translate_tokenized_lines(tokenized, line_indices, tokenizer, model, batch_size=None, max_new_tokens=512, num_beams=None, max_tokens=None, batcher=None):
+    """
+    Translate lines of a TokenizedFile (see tokenization_cache.py). Batches are built
+    from the precomputed lengths and token ids, without calling the tokenizer.
+    """
+    line_indices = list(line_indices)
+
+    def run_batch(batch):
+        input_ids, attention_mask = tokenized.padded_batch([line_indices[i] for i in batch], tokenizer.pad_token_id)
+        output = generate_from_ids(input_ids, attention_mask, model, max_new_tokens, num_beams)
+        return tokenizer.batch_decode(output, skip_special_tokens=True)
+
+    return run_batches(tokenized.lengths[line_indices].tolist(), run_batch, batch_size, max_tokens, batcher)
+
+
+def translate_batch(sentences, tokenizer, model, max_new_tokens=512, num_beams=None):
+    # Tokenize, generate and decode one batch of sentences
+    output = generate_batch(sentences, tokenizer, model, max_new_tokens, num_beams)
+    return tokenizer.batch_decode(output, skip_special_tokens=True)
+
+
+def translate_batch_with_attention(sentences, tokenizer, model, max_new_tokens=512, num_beams=None):
+    """
+    Translate one batch and collect the cross-attention weights in the same generate call.
+    Returns a list of (translation, attention, src_tokens, tgt_tokens) with attention
+    an array of shape (layers, heads, target tokens, source tokens) without padding.
+    """
+    tokenized_inputs = tokenizer(sentences, return_tensors="pt", padding=True, max_length=512, truncation=True)
+    n_beams = beam_size(model, num_beams)
+    with torch.no_grad():
+        output = model.generate(**tokenized_inputs, max_new_tokens=max_target_tokens(model, max_new_tokens), **beam_kwargs(num_beams),
+                                output_attentions=True, return_dict_in_generate=True,
+                                # beam_indices are only returned together with the scores
+                                output_scores=n_beams > 1)
+
+    # output.cross_attentions: one tuple per generation step, each holding one
+    # (batch x beams, heads, 1, source length) tensor per decoder layer
+    steps = [torch.stack(step_attentions, dim=0)[:, :, :, -1, :] for step_attentions in output.cross_attentions]
+    results = []
+    for b in range(len(sentences)):
+        generated = output.sequences[b, 1:].tolist()
+        # Target length up to and including </s>
+        n_tgt = generated.index(tokenizer.eos_token_id) + 1 if tokenizer.eos_token_id in generated else len(generated)
+        n_src = int(tokenized_inputs["attention_mask"][b].sum())
+        if n_beams > 1:
+            # With beam search the row of each step is the beam the final hypothesis came from
+            rows = output.beam_indices[b, :n_tgt].tolist()
+        else:
+            rows = [b] * n_tgt
+        n_tgt = min(n_tgt, len(steps))
+        attention = torch.stack([steps[t][:, row, :, :n_src] for t, row in zip(range(n_tgt), rows)], dim=2)
+        results.append((
+            tokenizer.decode(generated, skip_special_tokens=True),
+            attention.float().numpy(),
+            tokenizer.convert_ids_to_tokens(tokenized_inputs["input_ids"][b, :n_src].tolist()),
+            tokenizer.convert_ids_to_tokens(generated[:n_tgt]),
+        ))
+    return results
+
+
+def translate_lines_with_attention(lines, tokenizer, model, store, batch_size=16, max_new_tokens=512, num_beams=None, batcher=None):
+    """
+    Translate the lines of a parsed_data text file and write the cross-attention of every
+    sentence to store (an AttentionStore), indexed by (document, sentence) numbers.
+    """
+    documents = split_documents(lines)
+    keys = {line_number: (d, s) for d, document in enumerate(documents) for s, (line_number, _) in enumerate(document)}
+    sentences = [sentence for document in documents for _, sentence in document]
+    line_numbers = [line_number for document in documents for line_number, _ in document]
+
+    def run_batch(batch):
+        results = translate_batch_with_attention([sentences[i] for i in batch], tokenizer, model, max_new_tokens, num_beams)
+        # The attention is written as soon as a batch is done, so that it is never all held in memory
+        for i, (_, attention, src_tokens, tgt_tokens) in zip(batch, results):
+            store.add(*keys[line_numbers[i]], attention, src_tokens, tgt_tokens)
+        return [translation for translation, _, _, _ in results]
+
+    translated_lines = [""] * len(lines)
+    translations = run_batches(source_lengths(sentences, tokenizer), run_batch, batch_size, batcher=batcher)
+    for line_number, translation in zip(line_numbers, translations):
+        translated_lines[line_number] = translation
+    return translated_lines
+
+
+def source_lengths(sentences, tokenizer):
+    # Number of source tokens of each sentence, used to build length-bucketed batches
+    return [len(ids) for ids in tokenizer(sentences, max_length=512, truncation=True)["input_ids"]] if sentences else []
+
+
+def translate_sentences(sentences, tokenizer, model, batch_size=None, max_new_tokens=512, num_beams=None, max_tokens=None, batcher=None):
+    """Translate a list of sentences in length-bucketed batches, returning them in input order."""
+
+    def run_batch(batch):
+        return translate_batch([sentences[i] for i in batch], tokenizer, model, max_new_tokens, num_beams)
+
+    return run_batches(source_lengths(sentences, tokenizer), run_batch, batch_size, max_tokens, batcher)
+
+
+def is_out_of_memory(error):
+    # CPU allocation failures surface as MemoryError or as a RuntimeError from the torch allocator
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+class AdaptiveBatcher:
+    """
+    Memory-aware batch sizing for translation.
+
+    The memory of a batch is estimated as
+        sentences x beams x (padded length x bytes_per_token + bytes_per_sequence)
+    where bytes_per_token covers the encoder states and the decoder key/value caches, and
+    bytes_per_sequence the output logits. Batches are filled while the estimate stays under
+    the current budget, which is itself kept under the free room below max_rss_bytes.
+    When an allocation fails, the batch is split in two and retried and the budget is halved;
+    after grow_after successful batches in a row, the budget grows again by grow_factor.
+    """
+
+    def __init__(self, model, max_rss_bytes, num_beams=None, grow_after=8, grow_factor=1.25, safety_factor=2.0):
+        import psutil
+
+        config = model.config
+        d_model = config.d_model
+        n_layers = config.encoder_layers + 2 * config.decoder_layers
+        # float32 states per source token: encoder layers, self- and cross-attention key/value caches
+        self.bytes_per_token = safety_factor * 4 * d_model * 2 * n_layers
+        self.bytes_per_sequence = safety_factor * 4 * config.vocab_size
+        self.max_rss_bytes = max_rss_bytes
+        self.num_beams = beam_size(model, num_beams)
+        self.grow_after = grow_after
+        self.grow_factor = grow_factor
+        self._process = psutil.Process()
+        # Start with half of the free room and adapt from there
+        self.budget_bytes = max(self.free_bytes() / 2, self.estimate_bytes(1, 1))
+        self._successes = 0
+        self.n_splits = 0
+
+    def free_bytes(self):
+        return max(0, self.max_rss_bytes - self._process.memory_info().rss)
+
+    def estimate_bytes(self, n_sentences, padded_length):
+        return n_sentences * self.num_beams * (padded_length * self.bytes_per_token + self.bytes_per_sequence)
+
+    def next_batch(self, pending, start, lengths):
+        """Largest batch from pending[start:] (sorted by decreasing length) that fits the budget."""
+        budget = min(self.budget_bytes, self.free_bytes())
+        # The first sentence is the longest one, it sets the padded length of the batch
+        padded_length = lengths[pending[start]]
+        end = start + 1
+        while end < len(pending) and self.estimate_bytes(end - start + 1, padded_length) <= budget:
+            end += 1
+        return pending[start:end]
+
+    def run(self, lengths, run_batch):
+        outputs = [None] * len(lengths)
+        # Longest sentences first, so that the tightest batches are sized while memory is still free
+        pending = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        # Batches that failed and must be retried in smaller pieces
+        retry = []
+        start = 0
+        while start < len(pending) or retry:
+            if retry:
+                batch = retry.pop()
+            else:
+                batch = self.next_batch(pending, start, lengths)
+                start += len(batch)
+            try:
+                results = run_batch(batch)
+            except Exception as e:
+                if not is_out_of_memory(e) or len(batch) == 1:
+                    raise
+                # Split the batch and retry with a smaller budget
+                self.n_splits += 1
+                self._successes = 0
+                self.budget_bytes = max(self.budget_bytes / 2, self.estimate_bytes(1, lengths[batch[0]]))
+                half = len(batch) // 2
+                retry.extend([batch[half:], batch[:half]])
+                continue
+
+            for i, output in zip(batch, results):
+                outputs[i] = output
+            self._successes += 1
+            if self._successes >= self.grow_after:
+                self._successes = 0
+                self.budget_bytes = min(self.budget_bytes * self.grow_factor, max(self.free_bytes(), self.budget_bytes))
+        return outputs
+
+
+def _pool_worker(model_name, num_threads, task_queue, result_queue, shared_model, quantized=False, backend="torch"):
+    # Each worker uses a fixed number of intra-op threads so that N workers do not oversubscribe the cores
+    torch.set_num_threads(num_threads)
+    if shared_model is not None:
+        # Forked worker: the weights live in shared memory and are not copied
+        tokenizer, model = shared_model
+    else:
+        tokenizer, model = load_model(model_name, quantized=quantized, backend=backend)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_id, sentences, max_new_tokens, num_beams = task
+        try:
+            result_queue.put((batch_id, translate_batch(sentences, tokenizer, model, max_new_tokens, num_beams), None))
+        except Exception as e:
+            result_queue.put((batch_id, None, repr(e)))
+
+
+class TranslationPool:
+    """
+    Multi-process CPU inference pool.
+
+    Starts n_workers processes that each translate with num_threads intra-op threads.
+    With share_weights=True (Linux only) the model is loaded once in the parent, moved
+    to shared memory and inherited by forked workers; otherwise every worker loads its
+    own copy. Length-bucketed batches are fed through a queue and the translations are
+    put back in input order.
+
+        with TranslationPool("Helsinki-NLP/opus-mt-en-de", n_workers=4) as pool:
+            translations = pool.translate(sentences, batch_size=16)
+    """
+
+    def __init__(self, model_name, n_workers=2, num_threads=1, share_weights=True, quantized=False, backend="torch"):
+        self.model_name = model_name
+        self.quantized = quantized
+        self.backend = backend
+        self.n_workers = n_workers
+        self.num_threads = num_threads
+        # ONNX Runtime sessions are not torch modules, every worker opens its own
+        self.share_weights = share_weights and backend == "torch" and "fork" in mp.get_all_start_methods()
+        self._workers = []
+
+    def start(self):
+        self._tokenizer, model = load_model(self.model_name, quantized=self.quantized, backend=self.backend)
+        if self.share_weights:
+            model.share_memory()
+            ctx = mp.get_context("fork")
+            shared_model = (self._tokenizer, model)
+        else:
+            ctx = mp.get_context("spawn")
+            shared_model = None
+
+        self._task_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        for _ in range(self.n_workers):
+            worker = ctx.Process(target=_pool_worker, args=(self.model_name, self.num_threads, self._task_queue, self._result_queue, shared_model, self.quantized, self.backend), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def translate(self, sentences, batch_size=16, max_new_tokens=512, num_beams=None, max_tokens=None):
+        lengths = source_lengths(sentences, self._tokenizer)
+        batches = length_bucketed_batches(lengths, batch_size, max_tokens)
+        # Longest batches first so that the slowest work is not left for the end
+        for batch_id in reversed(range(len(batches))):
+            self._task_queue.put((batch_id, [sentences[i] for i in batches[batch_id]], max_new_tokens, num_beams))
+
+        translations = [None] * len(sentences)
+        for _ in range(len(batches)):
+            batch_id, outputs, error = self._result_queue.get()
+            if error is not None:
+                raise RuntimeError(f"Translation worker failed on batch {batch_id}: {error}")
+            for i, translation in zip(batches[batch_id], outputs):
+                translations[i] = translation
+        return translations
+
+    def close(self):
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compare_pool_throughput(sentences, model_name="Helsinki-NLP/opus-mt-en-de", n_workers=2, num_threads=1, batch_size=16):
+    """Print sentences/sec of the single-process path against the worker pool on the same sentences."""
+    tokenizer, model = load_model(model_name)
+    # Warm-up so that the single-process timing does not include one-off initialisation
+    translate_batch(sentences[:1], tokenizer, model)
+
+    start = time.perf_counter()
+    single_outputs = translate_sentences(sentences, tokenizer, model, batch_size=batch_size)
+    single_time = time.perf_counter() - start
+
+    with TranslationPool(model_name, n_workers=n_workers, num_threads=num_threads) as pool:
+        start = time.perf_counter()
+        pool_outputs = pool.translate(sentences, batch_size=batch_size)
+        pool_time = time.perf_counter() - start
+
+    print(f"Single process ({torch.get_num_threads()} threads): {len(sentences) / single_time:.2f} sentences/sec")
+    print(f"Pool ({n_workers} workers x {num_threads} threads): {len(sentences) / pool_time:.2f} sentences/sec")
+    print(f"Speed-up: {single_time / pool_time:.2f}x, identical outputs: {single_outputs == pool_outputs}")
+    return single_time, pool_time
+
+
+def quantization_parity_check(input_file, reference_file, model_name="Helsinki-NLP/opus-mt-en-de", target_lang="de", batch_size=16):
+    """
+    Translate input_file with the fp32 and the int8 model and report the BLEU and
+    BERTScore drift against reference_file, together with latency and model size.
+    Empty lines (document separators) are skipped in both files.
+    """
+    # Imported here so that plain translation runs do not pay for the metric packages
+    import sacrebleu
+    from bert_score import BERTScorer
+
+    with open(input_file, "r") as file:
+        sources = [line for line in file.read().splitlines() if line.strip()]
+    with open(reference_file, "r") as file:
+        references = [line for line in file.read().splitlines() if line.strip()]
+    if len(sources) != len(references):
+        raise ValueError(f"{input_file} has {len(sources)} sentences but {reference_file} has {len(references)}")
+
+    scorer = BERTScorer(lang=target_lang, rescale_with_baseline=True)
+    results = {}
+    for quantized in (False, True):
+        tokenizer, model = load_model(model_name, quantized=quantized)
+        start = time.perf_counter()
+        hypotheses = translate_sentences(sources, tokenizer, model, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+
+        _, _, bert_f1 = scorer.score(hypotheses, references)
+        results["int8" if quantized else "fp32"] = {
+            "bleu": sacrebleu.corpus_bleu(hypotheses, [references]).score,
+            "bert_score": bert_f1.mean().item(),
+            "sentences_per_sec": len(sources) / elapsed,
+            "model_mb": model_memory_bytes(model) / 2**20,
+            "hypotheses": hypotheses,
+        }
+
+    fp32, int8 = results["fp32"], results["int8"]
+    print(f"{'':12}{'fp32':>10}{'int8':>10}{'drift':>10}")
+    for name in ("bleu", "bert_score", "sentences_per_sec", "model_mb"):
+        print(f"{name:12}{fp32[name]:10.3f}{int8[name]:10.3f}{int8[name] - fp32[name]:+10.3f}")
+    identical = sum(a == b for a, b in zip(fp32["hypotheses"], int8["hypotheses"]))
+    print(f"Identical translations: {identical}/{len(sources)}")
+    return results
+
+
+def compare_backends(sentences, model_name="Helsinki-NLP/opus-mt-en-de", beam_sizes=(1, 4), batch_size=16):
+    """
+    Translate the same sentences with the PyTorch and the ONNX Runtime backends,
+    for greedy and beam search, and print the speed of each and how many outputs are identical.
+    """
+    results = {}
+    for num_beams in beam_sizes:
+        for backend in ("torch", "onnx"):
+            tokenizer, model = load_model(model_name, backend=backend)
+            # Warm-up so that the timing does not include session initialisation
+            translate_batch(sentences[:1], tokenizer, model, num_beams=num_beams)
+            start = time.perf_counter()
+            translations = translate_sentences(sentences, tokenizer, model, batch_size=batch_size, num_beams=num_beams)
+            results[backend, num_beams] = (time.perf_counter() - start, translations)
+
+        torch_time, torch_outputs = results["torch", num_beams]
+        onnx_time, onnx_outputs = results["onnx", num_beams]
+        identical = sum(a == b for a, b in zip(torch_outputs, onnx_outputs))
+        print(f"beams={beam_size(model, num_beams)}: torch {len(sentences) / torch_time:.2f} sent/s, onnx {len(sentences) / onnx_time:.2f} sent/s "
+              f"(speed-up {torch_time / onnx_time:.2f}x), identical outputs {identical}/{len(sentences)}")
+    return results
+
+
+def split_documents(lines):
+    """
+    Split the lines of a parsed_data text file into documents (csv_to_txt separates
+    documents with an empty line). Returns a list of documents, each a list of
+    (line number, sentence) pairs.
+    """
+    documents, current = [], []
+    for line_number, line in enumerate(lines):
+        if line.strip():
+            current.append((line_number, line))
+        elif current:
+            documents.append(current)
+            current = []
+    if current:
+        documents.append(current)
+    return documents
+
+
+class ForcedPrefixLogitsProcessor(LogitsProcessor):
+    """
+    Forces each sequence of the batch to start with its own token prefix
+    (the translation of its context), after which decoding is free.
+    """
+
+    def __init__(self, prefixes, num_beams=1):
+        self.prefixes = prefixes
+        self.num_beams = num_beams
+
+    def __call__(self, input_ids, scores):
+        # input_ids starts with the decoder start token, so this is the index of the token being generated
+        step = input_ids.shape[1] - 1
+        for row in range(input_ids.shape[0]):
+            prefix = self.prefixes[row // self.num_beams]
+            if step < len(prefix):
+                forced_token = prefix[step]
+                scores[row, :] = -float("inf")
+                scores[row, forced_token] = 0
+        return scores
+
+
+def translate_documents(documents, tokenizer, model, k=3, batch_size=16, max_length=512, max_new_tokens=512, num_beams=None, batcher=None):
+    """
+    Concatenation baseline: translate sentence i of each document with its k previous
+    sentences prepended on the source side. The translations of those k sentences are
+    forced as the start of the output, so the tokens generated after them are the
+    translation of sentence i alone.
+
+    Documents are walked in order, one sentence position at a time for all documents
+    (sentence i needs the translations of the sentences before it). Each source sentence
+    and each translation is tokenized once; the windows are built by concatenating
+    the cached token ids instead of tokenizing the joined text again.
+
+    Source windows and target sequences must fit the position embeddings of the model.
+    When they do not, the oldest context sentences are dropped from both the source
+    window and the forced prefix; the prefix may take at most half of the decoder
+    positions, the rest is left to the current sentence.
+
+    With an AdaptiveBatcher, the batches of each sentence position are sized by its
+    memory budget instead of batch_size.
+
+    documents: list of lists of sentences. Returns the translations with the same shape.
+    """
+    eos_id = tokenizer.eos_token_id
+    pad_id = tokenizer.pad_token_id
+    max_positions = getattr(model.config, "max_position_embeddings", None)
+    if max_positions:
+        max_length = min(max_length, max_positions)
+    # Decoder tokens after the start token: forced prefix plus generated tokens
+    target_budget = max_target_tokens(model, float("inf"))
+    prefix_budget = target_budget // 2
+
+    # Source token ids of every sentence, without the final </s>
+    source_ids = [[ids[:-1] for ids in tokenizer(document)["input_ids"]] if document else [] for document in documents]
+    target_ids = [[None] * len(document) for document in documents]
+    translations = [[None] * len(document) for document in documents]
+
+    n_steps = max((len(document) for document in documents), default=0)
+    for position in range(n_steps):
+        items = [d for d, document in enumerate(documents) if position < len(document)]
+        first = max(0, position - k)
+
+        windows, prefixes = [], []
+        for d in items:
+            # Drop the oldest context sentences, on both sides, until the window and the prefix fit
+            start = first
+            while start < position and (sum(len(ids) for ids in source_ids[d][start:position + 1]) > max_length - 1
+                                        or sum(len(ids) for ids in target_ids[d][start:position]) > prefix_budget):
+                start += 1
+            window = [token for ids in source_ids[d][start:position + 1] for token in ids]
+            # Keep the end of the current sentence if it is too long on its own
+            windows.append(window[-(max_length - 1):] + [eos_id])
+            prefixes.append([token for ids in target_ids[d][start:position] for token in ids])
+
+        lengths = [len(window) for window in windows]
+
+        def run_batch(batch):
+            longest = max(lengths[b] for b in batch)
+            input_ids = torch.full((len(batch), longest), pad_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), longest), dtype=torch.long)
+            for row, b in enumerate(batch):
+                input_ids[row, :lengths[b]] = torch.tensor(windows[b])
+                attention_mask[row, :lengths[b]] = 1
+
+            batch_prefixes = [prefixes[b] for b in batch]
+            processor = ForcedPrefixLogitsProcessor(batch_prefixes, beam_size(model, num_beams))
+            longest_prefix = max(len(prefix) for prefix in batch_prefixes)
+            output = generate_from_ids(input_ids, attention_mask, model, min(max_new_tokens + longest_prefix, target_budget), num_beams,
+                                       logits_processor=LogitsProcessorList([processor]))
+
+            generated_ids = []
+            for row, b in enumerate(batch):
+                # Drop the decoder start token and the forced context translation
+                generated = output[row, 1 + len(prefixes[b]):].tolist()
+                current = []
+                for token in generated:
+                    if token in (eos_id, pad_id):
+                        break
+                    current.append(token)
+                generated_ids.append(current)
+            return generated_ids
+
+        for d, current in zip(items, run_batches(lengths, run_batch, batch_size, batcher=batcher)):
+            target_ids[d][position] = current
+            translations[d][position] = tokenizer.decode(current, skip_special_tokens=True)
+
+    return translations
+
+
+def translate_lines_in_context(lines, tokenizer, model, k=3, batch_size=16, num_beams=None, batcher=None):
+    """Translate the lines of a parsed_data text file document by document, keeping empty separator lines."""
+    documents = split_documents(lines)
+    translations = translate_documents([[sentence for _, sentence in document] for document in documents], tokenizer, model, k=k, batch_size=batch_size, num_beams=num_beams, batcher=batcher)
+    translated_lines = [""] * len(lines)
+    for document, document_translations in zip(documents, translations):
+        for (line_number, _), translation in zip(document, document_translations):
+            translated_lines[line_number] = translation
+    return translated_lines
+
+
+def model_fingerprint(model_name, model, quantized=False, backend="torch"):
+    """Identifies the exact weights a translation comes from (used by the translation cache)."""
+    return {
+        "model_name": model_name,
+        "quantized": quantized,
+        "backend": backend,
+        # Hub revision of the weights (hash of the files for a local model), so that a model update invalidates the cache.
+        # Taken from model_name rather than model.config, which has no commit hash for ONNX Runtime models
+        "revision": model_revision(model_name),
+        "config": model.config.to_json_string(use_diff=True),
+    }
+
+
+def generation_fingerprint(model, max_new_tokens=512, num_beams=None):
+    """Every decoding parameter used by translate_batch, with the beam size actually used."""
+    return {"max_new_tokens": max_new_tokens, "num_beams": beam_size(model, num_beams), "generation_config": model.generation_config.to_dict()}
+
+
+def translate_and_convert_to_csv(input_file, output_csv, model_name="Helsinki-NLP/opus-mt-en-de", input_delimiter='\t', registry=None, batch_size=None, n_workers=0, num_threads=1, quantized=False, cache=None, context_size=0, num_beams=None, max_tokens=None, backend="torch", attention_store=None, tokenization_cache_dir=None, max_rss_mb=None):
+    if tokenization_cache_dir is not None and (n_workers > 0 or attention_store is not None or context_size > 0):
+        # Workers tokenize their own batches, the attention and context paths tokenize per batch or per window
+        raise ValueError("The tokenization cache is not supported with worker processes, the attention store or the context mode")
+    if max_rss_mb and n_workers > 0:
+        # The ceiling is measured on this process, the workers allocate in their own
+        raise ValueError("The memory ceiling (max_rss_mb) is not supported with worker processes")
+
+    # Step 1: Get the pre-trained model and tokenizer (loaded once per process)
+    tokenizer, model = load_model(model_name, registry, quantized=quantized, backend=backend)
 
     # Step 2: Read the input English sentences from the file
     with open(input_file, "r") as file:
         english_sentences = file.read().splitlines()
 
-    # Step 3: Tokenize the input English sentences
-    tokenized_inputs = tokenizer(english_sentences, return_tensors="pt", padding=True, max_length=512, truncation=True)
+    # Step 3-5: Tokenize, translate and decode the input English sentences
+    tokenized = None
+    if tokenization_cache_dir is not None:
+        # Token ids of every line, computed once per tokenizer and file content
+        tokenized = tokenize_file(input_file, tokenizer, cache_dir=tokenization_cache_dir)
+        line_of = {}
+        for line_number, line in enumerate(english_sentences):
+            line_of.setdefault(line, line_number)
+            line_of.setdefault(normalize_source(line), line_number)
 
-    # Step 4: Perform translation
-    with torch.no_grad():
-        output = model.generate(**tokenized_inputs, max_new_tokens=512)
+    # Batch sizes adapted to a memory ceiling instead of a fixed batch size
+    batcher = AdaptiveBatcher(model, max_rss_mb * 2**20, num_beams=num_beams) if max_rss_mb else None
 
-    # Step 5: Decode the translated output
-    translated_sentences = tokenizer.batch_decode(output, skip_special_tokens=True)
+    def translate_fn(sentences):
+        if tokenized is not None:
+            return translate_tokenized_lines(tokenized, [line_of[sentence] for sentence in sentences], tokenizer, model,
+                                             batch_size=batch_size, num_beams=num_beams, max_tokens=max_tokens, batcher=batcher)
+        if n_workers > 0:
+            with TranslationPool(model_name, n_workers=n_workers, num_threads=num_threads, quantized=quantized, backend=backend) as pool:
+                return pool.translate(sentences, batch_size=batch_size or 16, num_beams=num_beams, max_tokens=max_tokens)
+        return translate_sentences(sentences, tokenizer, model, batch_size=batch_size, num_beams=num_beams, max_tokens=max_tokens, batcher=batcher)
+
+    if attention_store is not None:
+        # Cross-attention is collected during generation, so every line goes through the model
+        translated_sentences = translate_lines_with_attention(english_sentences, tokenizer, model, attention_store, batch_size=batch_size or 16, num_beams=num_beams, batcher=batcher)
+    elif context_size > 0:
+        # Document-level concatenation baseline, the translation of a line depends on its context so it is not cached
+        translated_sentences = translate_lines_in_context(english_sentences, tokenizer, model, k=context_size, batch_size=batch_size or 16, num_beams=num_beams, batcher=batcher)
+    elif cache is not None:
+        # Only the sentences missing from the translation memory reach the model
+        translated_sentences = cache.translate(english_sentences, translate_fn, model_fingerprint(model_name, model, quantized, backend), generation_fingerprint(model, num_beams=num_beams))
+        print(cache.report())
+    else:
+        translated_sentences = translate_fn(english_sentences)
 
     # Step 6: Save the translations to a new file
     with open(output_csv, "w") as file:
@@ -43,11 +874,55 @@ def translate_and_convert_to_csv(input_file, output_csv, model_name="Helsinki-NL
     print(f"Conversion successful. The CSV file '{output_csv}' has been created.")
 
 def main():
+    parser = argparse.ArgumentParser(description="Translate a text file with the sentence-level baseline model.")
     # Replace these paths with your actual input and output file paths
-    input_file = "/home/user/Documents/GitHub/CA-NMT_evaluation/parsed_data/EN/DiscoMT_news/short_EN.txt"
-    output_csv = "/home/user/Documents/GitHub/CA-NMT_evaluation/Multi-encoder_k3_model/translation_outputs/output_VANILLA_german.csv"
+    parser.add_argument("--input_file", default="/home/user/Documents/GitHub/CA-NMT_evaluation/parsed_data/EN/DiscoMT_news/short_EN.txt")
+    parser.add_argument("--output_csv", default="/home/user/Documents/GitHub/CA-NMT_evaluation/Multi-encoder_k3_model/translation_outputs/output_VANILLA_german.csv")
+    parser.add_argument("--model_name", default="Helsinki-NLP/opus-mt-en-de")
+    parser.add_argument("--batch_size", type=int, default=None, help="Sentences per length-bucketed batch (default: one batch)")
+    parser.add_argument("--max_batch_tokens", type=int, default=None, help="Maximum padded source tokens per batch")
+    parser.add_argument("--beams", type=int, default=None, help="Beam size (1: greedy decoding, default: the model's generation config)")
+    parser.add_argument("--max_rss_mb", type=int, default=None, help="Size batches adaptively to keep the process RSS under this ceiling")
+    parser.add_argument("--workers", type=int, default=0, help="Number of worker processes (0: translate in this process)")
+    parser.add_argument("--threads", type=int, default=1, help="Intra-op threads per worker process")
+    parser.add_argument("--compare_throughput", action="store_true", help="Compare single-process and worker-pool throughput on the input file")
+    parser.add_argument("--quantize", action="store_true", help="Translate with the dynamically int8-quantized model")
+    parser.add_argument("--quantization_parity", metavar="REFERENCE_FILE", default=None, help="Report BLEU/BERTScore drift of the int8 model against fp32 on the input file")
+    parser.add_argument("--target_lang", default="de", help="Target language used by BERTScore in the parity check")
+    parser.add_argument("--cache", metavar="SQLITE_FILE", default=None, help="Translation memory: reuse translations of sentences seen in earlier runs")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"], help="Inference backend (onnx: exported encoder/decoder run by ONNX Runtime)")
+    parser.add_argument("--compare_backends", action="store_true", help="Compare speed and outputs of the torch and onnx backends on the input file")
+    parser.add_argument("--attention_store", metavar="DIRECTORY", default=None, help="Save the cross-attention of every sentence (float16, indexed by document and sentence)")
+    parser.add_argument("--attention_layers", type=int, nargs="+", default=None, help="Decoder layers kept in the attention store (default: all)")
+    parser.add_argument("--attention_heads", type=int, nargs="+", default=None, help="Attention heads kept in the attention store (default: all)")
+    parser.add_argument("--tokenization_cache", metavar="DIRECTORY", nargs="?", const=TOKENIZATION_CACHE_DIR, default=None, help="Reuse the token ids of the input file from earlier runs (default directory: %(const)s)")
+    parser.add_argument("--context", type=int, default=0, help="Concatenation baseline: translate each sentence with its k previous sentences (0: sentence-level)")
+    args = parser.parse_args()
+
+    if args.compare_backends:
+        with open(args.input_file, "r") as file:
+            sentences = [line for line in file.read().splitlines() if line.strip()]
+        compare_backends(sentences, args.model_name, beam_sizes=sorted({1, args.beams}) if args.beams else (1, None), batch_size=args.batch_size or 16)
+        return
+
+    if args.quantization_parity:
+        quantization_parity_check(args.input_file, args.quantization_parity, args.model_name, target_lang=args.target_lang, batch_size=args.batch_size or 16)
+        return
+
+    if args.compare_throughput:
+        with open(args.input_file, "r") as file:
+            sentences = [line for line in file.read().splitlines() if line.strip()]
+        compare_pool_throughput(sentences, args.model_name, n_workers=max(args.workers, 1), num_threads=args.threads, batch_size=args.batch_size or 16)
+        return
+
+    attention_store = None
+    if args.attention_store:
+        attention_store = AttentionStore(args.attention_store, mode="w", layers=args.attention_layers, heads=args.attention_heads)
+
+    translate_and_convert_to_csv(args.input_file, args.output_csv, model_name=args.model_name, batch_size=args.batch_size, n_workers=args.workers, num_threads=args.threads, quantized=args.quantize, cache=TranslationCache(args.cache) if args.cache else None, context_size=args.context, num_beams=args.beams, max_tokens=args.max_batch_tokens, backend=args.backend, attention_store=attention_store, tokenization_cache_dir=args.tokenization_cache, max_rss_mb=args.max_rss_mb)
 
-    translate_and_convert_to_csv(input_file, output_csv)
+    if attention_store is not None:
+        attention_store.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import itertools
+import math
+import json
+import os
+import platform
+import random
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+
+def percentile(values, q):
+    # Nearest-rank percentile, enough for per-batch latencies
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def load_sample(input_file, sample_size, seed=0):
+    """Fixed sample of non-empty lines from a parsed_data text file, kept in file order."""
+    with open(input_file, "r") as file:
+        sentences = [line for line in file.read().splitlines() if line.strip()]
+    if sample_size is None or sample_size >= len(sentences):
+        return sentences
+    indices = sorted(random.Random(seed).sample(range(len(sentences)), sample_size))
+    return [sentences[i] for i in indices]
+
+
+def run_setting(sentences, model_name, num_beams, max_tokens, num_threads, quantized, max_new_tokens=512):
+    """
+    Translate the sample with one setting. Runs in a fresh process (see benchmark),
+    so that the thread count and the peak RSS belong to this setting only.
+    """
+    import torch
+    from baseline import load_model, length_bucketed_batches, source_lengths, generate_batch
+
+    torch.set_num_threads(num_threads)
+    tokenizer, model = load_model(model_name, quantized=quantized)
+    # Warm-up batch, not timed
+    generate_batch(sentences[:1], tokenizer, model, max_new_tokens, num_beams)
+
+    lengths = source_lengths(sentences, tokenizer)
+    batches = length_bucketed_batches(lengths, max_tokens=max_tokens)
+    latencies = []
+    generated_tokens = 0
+    start = time.perf_counter()
+    for batch in batches:
+        batch_start = time.perf_counter()
+        output = generate_batch([sentences[i] for i in batch], tokenizer, model, max_new_tokens, num_beams)
+        latencies.append(time.perf_counter() - batch_start)
+        # Count real output tokens, not padding nor the decoder start token
+        generated_tokens += int((output[:, 1:] != tokenizer.pad_token_id).sum())
+    elapsed = time.perf_counter() - start
+
+    return {
+        "num_beams": num_beams,
+        "max_batch_tokens": max_tokens,
+        "threads": num_threads,
+        "precision": "int8" if quantized else "fp32",
+        "n_batches": len(batches),
+        "sentences_per_sec": len(sentences) / elapsed,
+        "generated_tokens_per_sec": generated_tokens / elapsed,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def benchmark(sentences, model_name, beams=(1, 4), batch_tokens=(1024, 4096), threads=(1, 4), precisions=("fp32", "int8")):
+    """Run every combination of the decoding/batching/threading/precision grid and return the results."""
+    results = []
+    # spawn: a clean interpreter per setting, with nothing inherited from previous settings
+    ctx = mp.get_context("spawn")
+    for num_beams, max_tokens, num_threads, precision in itertools.product(beams, batch_tokens, threads, precisions):
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            result = executor.submit(run_setting, sentences, model_name, num_beams, max_tokens, num_threads, precision == "int8").result()
+        print(f"beams={num_beams} tokens={max_tokens} threads={num_threads} {precision}: "
+              f"{result['sentences_per_sec']:.2f} sent/s, {result['generated_tokens_per_sec']:.1f} tok/s, "
+              f"p50={result['latency_p50']:.3f}s p95={result['latency_p95']:.3f}s p99={result['latency_p99']:.3f}s, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB")
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency benchmark of the baseline translator.")
+    parser.add_argument("--input_file", default="/home/user/Documents/GitHub/CA-NMT_evaluation/parsed_data/EN/DiscoMT_news/short_EN.txt")
+    parser.add_argument("--model_name", default="Helsinki-NLP/opus-mt-en-de")
+    parser.add_argument("--sample_size", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--beams", type=int, nargs="+", default=[1, 4], help="Beam sizes (1: greedy)")
+    parser.add_argument("--batch_tokens", type=int, nargs="+", default=[1024, 4096], help="Padded source tokens per batch")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "int8"], choices=["fp32", "int8"])
+    parser.add_argument("--output_dir", default="benchmark_results")
+    args = parser.parse_args()
+
+    sentences = load_sample(args.input_file, args.sample_size, args.seed)
+    results = benchmark(sentences, args.model_name, args.beams, args.batch_tokens, args.threads, args.precisions)
+
+    import torch
+    report = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model_name": args.model_name,
+        "input_file": args.input_file,
+        "sample_size": len(sentences),
+        "seed": args.seed,
+        "torch_version": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "machine": platform.platform(),
+        "results": results,
+    }
+    # One file per run, so that results can be compared over time
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file = os.path.join(args.output_dir, "baseline_{}.json".format(time.strftime("%Y%m%d-%H%M%S")))
+    with open(output_file, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Benchmark results have been saved to '{output_file}'.")
+
+
+if __name__ == "__main__":
+    main()
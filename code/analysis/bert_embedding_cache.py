@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import defaultdict
+import bert_score
+import numpy as np
+import torch
+import transformers
+from bert_score.utils import get_bert_embedding, greedy_cos_idf
+from torch.nn.utils.rnn import pad_sequence
+
+
+# Reference embeddings are cached here, one directory per (model, layer, IDF weights) setting
+BERT_EMBEDDING_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ca-nmt", "bert_embeddings")
+
+
+def text_hash(text):
+    # bert_score strips every sentence before encoding it
+    return hashlib.sha256(text.strip().encode("utf-8")).hexdigest()
+
+
+def _idf_dict(scorer):
+    # Same IDF weights as BERTScorer.score: uniform, except for [CLS] and [SEP] when IDF is off
+    if scorer.idf:
+        return scorer._idf_dict
+    idf_dict = defaultdict(lambda: 1.0)
+    idf_dict[scorer._tokenizer.sep_token_id] = 0
+    idf_dict[scorer._tokenizer.cls_token_id] = 0
+    return idf_dict
+
+
+def scorer_key(scorer):
+    """Directory name for everything that changes the token embeddings of a sentence."""
+    sha = hashlib.sha256()
+    sha.update(json.dumps({
+        "model_type": scorer.model_type,
+        "num_layers": scorer.num_layers,
+        "tokenizer": type(scorer._tokenizer).__name__,
+        "idf": sorted(scorer._idf_dict.items()) if scorer.idf else None,
+        "bert_score": bert_score.__version__,
+        "transformers": transformers.__version__,
+    }, sort_keys=True, default=str).encode("utf-8"))
+    return "{}-L{}-{}".format(scorer.model_type.replace("/", "--"), scorer.num_layers, sha.hexdigest()[:16])
+
+
+def embed_sentences(scorer, sentences, batch_size=64):
+    """
+    (token embeddings, IDF weights) of each sentence, as float16 and float32 arrays.
+    Sentences are encoded longest first, so that each batch holds sentences of similar length.
+    """
+    idf_dict = _idf_dict(scorer)
+    order = sorted(range(len(sentences)), key=lambda i: -len(sentences[i].split(" ")))
+    results = [None] * len(sentences)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        embeddings, masks, padded_idf = get_bert_embedding([sentences[i] for i in batch], scorer._model, scorer._tokenizer, idf_dict, device=scorer.device)
+        embeddings, masks, padded_idf = embeddings.cpu(), masks.cpu(), padded_idf.cpu()
+        for row, i in enumerate(batch):
+            length = int(masks[row].sum())
+            results[i] = (embeddings[row, :length].numpy().astype(np.float16), padded_idf[row, :length].numpy().astype(np.float32))
+    return results
+
+
+def _pad_stats(stats, device):
+    # Padded (embeddings, mask, IDF weights) tensors, as built by bert_score for greedy matching
+    embeddings = [torch.from_numpy(np.asarray(embedding, dtype=np.float32)) for embedding, _ in stats]
+    idf = [torch.from_numpy(np.array(weights, dtype=np.float32)) for _, weights in stats]
+    lengths = torch.tensor([len(embedding) for embedding in embeddings])
+    mask = torch.arange(int(lengths.max())).expand(len(lengths), -1) < lengths.unsqueeze(1)
+    return (pad_sequence(embeddings, batch_first=True, padding_value=2.0).to(device), mask.to(device),
+            pad_sequence(idf, batch_first=True).to(device))
+
+
+class ReferenceEmbeddingCache:
+    """
+    On-disk cache of the BERTScore token embeddings and IDF weights of reference sentences,
+    for one scorer setting. Entries are keyed by text hash and stored in shards: a float16
+    .npy memmap of all the token embeddings, float32 IDF weights, per-sentence offsets and
+    lengths, and the text hashes.
+
+        references = ReferenceEmbeddingCache(scorer)
+        P, R, F = references.score(hyps, refs)
+
+    Once the references of a test set are cached, scoring another system only runs the
+    model on its hypotheses. Fresh embeddings are rounded to float16 as well, so that
+    scores do not depend on whether the references were cached.
+    """
+
+    def __init__(self, scorer, cache_dir=None):
+        if scorer.all_layers:
+            raise ValueError("ReferenceEmbeddingCache does not support all_layers scorers")
+        self.scorer = scorer
+        self.directory = os.path.join(cache_dir or BERT_EMBEDDING_CACHE_DIR, scorer_key(scorer))
+        os.makedirs(self.directory, exist_ok=True)
+        self._shards = []
+        self._index = {}   # text hash -> (shard, row)
+        self._load_shards()
+
+    def _load_shards(self):
+        loaded = {shard["name"] for shard in self._shards}
+        for name in sorted(os.listdir(self.directory)):
+            shard_directory = os.path.join(self.directory, name)
+            # hashes.npy is written last, its presence marks a complete shard
+            if name in loaded or name.endswith(".tmp") or not os.path.exists(os.path.join(shard_directory, "hashes.npy")):
+                continue
+            shard = {
+                "name": name,
+                "embeddings": np.load(os.path.join(shard_directory, "embeddings.npy"), mmap_mode="r"),
+                "idf": np.load(os.path.join(shard_directory, "idf.npy"), mmap_mode="r"),
+                "offsets": np.load(os.path.join(shard_directory, "offsets.npy")),
+                "lengths": np.load(os.path.join(shard_directory, "lengths.npy")),
+            }
+            self._shards.append(shard)
+            for row, key in enumerate(np.load(os.path.join(shard_directory, "hashes.npy")).tolist()):
+                self._index.setdefault(key.decode("ascii"), (len(self._shards) - 1, row))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, text):
+        return text_hash(text) in self._index
+
+    def get(self, text):
+        """(float16 token embeddings, float32 IDF weights) of a cached sentence."""
+        shard_index, row = self._index[text_hash(text)]
+        shard = self._shards[shard_index]
+        start, length = shard["offsets"][row], shard["lengths"][row]
+        return shard["embeddings"][start:start + length], shard["idf"][start:start + length]
+
+    def add(self, texts, batch_size=64):
+        """Embed the sentences that are not cached yet and store them in a new shard. Returns their number."""
+        # Shards written by other processes since the last look are picked up first
+        self._load_shards()
+        missing = {}
+        for text in texts:
+            key = text_hash(text)
+            if key not in self._index and key not in missing:
+                missing[key] = text
+        if not missing:
+            return 0
+
+        stats = embed_sentences(self.scorer, list(missing.values()), batch_size)
+        lengths = np.array([len(embeddings) for embeddings, _ in stats], dtype=np.int32)
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths[:-1], dtype=np.int64)
+
+        # Build in a temporary directory and rename it, so that an interrupted run leaves no partial shard
+        name = "shard-{}-{}".format(time.time_ns(), os.getpid())
+        tmp_directory = os.path.join(self.directory, name + ".tmp")
+        os.makedirs(tmp_directory, exist_ok=True)
+        np.save(os.path.join(tmp_directory, "embeddings.npy"), np.concatenate([embeddings for embeddings, _ in stats]))
+        np.save(os.path.join(tmp_directory, "idf.npy"), np.concatenate([idf for _, idf in stats]))
+        np.save(os.path.join(tmp_directory, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_directory, "lengths.npy"), lengths)
+        np.save(os.path.join(tmp_directory, "hashes.npy"), np.array(list(missing), dtype="S64"))
+        try:
+            os.rename(tmp_directory, os.path.join(self.directory, name))
+        except OSError:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+        self._load_shards()
+        return len(missing)
+
+    def score(self, hyps, refs, batch_size=64):
+        """
+        BERTScore (P, R, F) tensors of every (hypothesis, reference) pair, like BERTScorer.score.
+        Missing references are embedded and cached first; hypotheses are always embedded.
+        """
+        self.add(refs, batch_size)
+        unique_hyps = list(dict.fromkeys(hyps))
+        hyp_stats = dict(zip(unique_hyps, embed_sentences(self.scorer, unique_hyps, batch_size)))
+
+        device = next(self.scorer._model.parameters()).device
+        preds = []
+        with torch.no_grad():
+            for start in range(0, len(refs), batch_size):
+                ref_stats = _pad_stats([self.get(ref) for ref in refs[start:start + batch_size]], device)
+                batch_hyp_stats = _pad_stats([hyp_stats[hyp] for hyp in hyps[start:start + batch_size]], device)
+                P, R, F = greedy_cos_idf(*ref_stats, *batch_hyp_stats)
+                preds.append(torch.stack((P, R, F), dim=-1).cpu())
+        preds = torch.cat(preds, dim=0) if preds else torch.zeros(0, 3)
+
+        if self.scorer.rescale_with_baseline:
+            preds = (preds - self.scorer.baseline_vals) / (1 - self.scorer.baseline_vals)
+        return preds[..., 0], preds[..., 1], preds[..., 2]
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+from edit_distance import SCLITE_WEIGHTS, TokenInterner, batch_banded_edit_distance, batch_edit_distance
+
+
+def read_text_pair(ref_file, hyp_file, genre=None):
+    """
+    Aligned lines of a reference and a hypothesis file in the parsed_data layout, where
+    documents are separated by an empty line. Returns (refs, hyps, documents, genres), one
+    entry per non-empty reference line; documents are "<ref_file>:<n>".
+    """
+    with open(ref_file, "r") as file:
+        ref_lines = file.read().splitlines()
+    with open(hyp_file, "r") as file:
+        hyp_lines = file.read().splitlines()
+    if len(ref_lines) != len(hyp_lines):
+        raise ValueError(f"'{ref_file}' has {len(ref_lines)} lines but '{hyp_file}' has {len(hyp_lines)}")
+
+    refs, hyps, documents = [], [], []
+    document = 0
+    for ref, hyp in zip(ref_lines, hyp_lines):
+        if not ref.strip():
+            # An empty line closes the current document
+            if refs and documents[-1] == f"{ref_file}:{document}":
+                document += 1
+            continue
+        refs.append(ref)
+        hyps.append(hyp)
+        documents.append(f"{ref_file}:{document}")
+    genres = [genre or os.path.basename(os.path.dirname(ref_file))] * len(refs)
+    return refs, hyps, documents, genres
+
+
+def read_table(path, ref_column, hyp_column, document_column=None, genre_column=None):
+    """Same as read_text_pair for the columns of a CSV or spreadsheet (.ods, .xlsx) file."""
+    import pandas as pd
+    if path.endswith(".csv"):
+        data = pd.read_csv(path)
+    else:
+        data = pd.read_excel(path, engine="odf" if path.endswith(".ods") else None)
+    refs = data[ref_column].fillna("").astype(str).tolist()
+    hyps = data[hyp_column].fillna("").astype(str).tolist()
+    documents = data[document_column].astype(str).tolist() if document_column else [path] * len(refs)
+    genres = data[genre_column].astype(str).tolist() if genre_column else [os.path.basename(path)] * len(refs)
+    return refs, hyps, documents, genres
+
+
+class SharedCorpus:
+    """
+    Token ids of all the references and hypotheses of a corpus, in shared memory: a flat
+    int32 array of ids and an int64 array of offsets for each side. Pool workers attach to
+    the blocks by name, so chunks are sent to them as index arrays, not as sentences.
+    """
+
+    def __init__(self, arrays, blocks=None, owner=False):
+        self.arrays = arrays
+        self._blocks = blocks or []
+        self._owner = owner
+
+    @classmethod
+    def create(cls, refs, hyps):
+        interner = TokenInterner()
+        arrays, blocks = {}, []
+        for side, sentences in (("ref", refs), ("hyp", hyps)):
+            encoded = [interner.encode(sentence) for sentence in sentences]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(ids) for ids in encoded])
+            ids = np.fromiter((token for ids in encoded for token in ids), dtype=np.int32, count=int(offsets[-1]))
+            for name, array in ((side + "_ids", ids), (side + "_offsets", offsets)):
+                # SharedMemory cannot be empty
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+                shared[:] = array
+                arrays[name] = shared
+                blocks.append(block)
+        return cls(arrays, blocks, owner=True)
+
+    def spec(self):
+        # What a worker needs to attach: block name, shape and dtype of each array
+        return {name: (block.name, array.shape, array.dtype.str) for (name, array), block in zip(self.arrays.items(), self._blocks)}
+
+    @classmethod
+    def attach(cls, spec):
+        arrays, blocks = {}, []
+        for name, (block_name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            blocks.append(block)
+        return cls(arrays, blocks)
+
+    def __len__(self):
+        return len(self.arrays["ref_offsets"]) - 1
+
+    def lengths(self, side):
+        return np.diff(self.arrays[side + "_offsets"])
+
+    def sequences(self, side, indices):
+        ids = self.arrays[side + "_ids"]
+        offsets = self.arrays[side + "_offsets"]
+        return [ids[offsets[i]:offsets[i+1]].tolist() for i in indices]
+
+    def close(self):
+        self.arrays = {}
+        for block in self._blocks:
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = []
+
+
+# Corpus attached by each pool worker
+_worker_corpus = None
+
+
+def _attach_worker(spec):
+    global _worker_corpus
+    _worker_corpus = SharedCorpus.attach(spec)
+
+
+def _score_chunk(indices, weights, corpus=None):
+    corpus = corpus if corpus is not None else _worker_corpus
+    n_ins, n_del, n_sub, _, _ = batch_edit_distance(corpus.sequences("ref", indices), corpus.sequences("hyp", indices), *weights)
+    return indices, n_ins, n_del, n_sub
+
+
+def score_corpus(refs, hyps, weights=(1.0, 1.0, 1.0), n_workers=None, chunk_size=2048):
+    """
+    Per-sentence (n_ins, n_del, n_sub, ref_lens) of a whole corpus. The corpus is encoded
+    once into shared memory, and chunks of length-sorted sentences are scored by
+    n_workers processes (default: one per core; 0 scores in this process).
+    """
+    if len(refs) != len(hyps):
+        raise ValueError(f"Got {len(refs)} references and {len(hyps)} hypotheses")
+    corpus = SharedCorpus.create(refs, hyps)
+    try:
+        ref_lens = corpus.lengths("ref")
+        # Sentences of similar length share a chunk, and long chunks are submitted first
+        order = np.argsort(-np.maximum(ref_lens, corpus.lengths("hyp")), kind="stable")
+        chunks = [order[start:start+chunk_size] for start in range(0, len(order), chunk_size)]
+        n_ins = np.zeros(len(corpus), dtype=np.int64)
+        n_del = np.zeros(len(corpus), dtype=np.int64)
+        n_sub = np.zeros(len(corpus), dtype=np.int64)
+
+        n_workers = os.cpu_count() if n_workers is None else n_workers
+        if n_workers == 0:
+            results = [_score_chunk(chunk, weights, corpus) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach_worker, initargs=(corpus.spec(),)) as executor:
+                results = list(executor.map(_score_chunk, chunks, [weights] * len(chunks)))
+        for indices, chunk_ins, chunk_del, chunk_sub in results:
+            n_ins[indices] = chunk_ins
+            n_del[indices] = chunk_del
+            n_sub[indices] = chunk_sub
+        return n_ins, n_del, n_sub, ref_lens.astype(np.int64)
+    finally:
+        corpus.close()
+
+
+def cross_check(refs, hyps, n_ins, n_del, n_sub, weights, n_samples=200, seed=0):
+    """
+    Check a sample of sentences: the weighted cost of their counts must be their weighted
+    edit distance, recomputed by the banded DP (which shares no code with the backtrace).
+    Raises ValueError on the first mismatch.
+    """
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(refs), size=min(n_samples, len(refs)), replace=False)
+    costs = n_ins[sample] * weights[0] + n_del[sample] * weights[1] + n_sub[sample] * weights[2]
+    # The cost of any alignment bounds the distance, so the largest cost is a safe threshold
+    distances = batch_banded_edit_distance([refs[i] for i in sample], [hyps[i] for i in sample], float(costs.max(initial=0)), *weights)
+    for i, distance, cost in zip(sample, distances, costs):
+        if not np.isclose(distance, cost):
+            raise ValueError(f"Sentence {i}: counts cost {cost} but the weighted edit distance is {distance}")
+    return len(sample)
+
+
+def aggregate(n_ins, n_del, n_sub, ref_lens, labels):
+    """Error counts and error rate summed over the sentences of each label (document, genre)."""
+    names, groups = np.unique(np.asarray(labels, dtype=object).astype(str), return_inverse=True)
+    totals = {key: np.bincount(groups, weights=values, minlength=len(names)).astype(np.int64)
+              for key, values in (("ins", n_ins), ("del", n_del), ("sub", n_sub), ("ref_len", ref_lens))}
+    totals["sentences"] = np.bincount(groups, minlength=len(names))
+    report = {}
+    for g, name in enumerate(names):
+        entry = {key: int(values[g]) for key, values in totals.items()}
+        entry["error_rate"] = (entry["ins"] + entry["del"] + entry["sub"]) / entry["ref_len"] if entry["ref_len"] else None
+        report[name] = entry
+    return report
+
+
+def corpus_edit_rate(refs, hyps, documents, genres, weights=(1.0, 1.0, 1.0), n_workers=None, chunk_size=2048, n_checks=200):
+    """
+    Corpus error rate with per-genre and per-document breakdowns. With non-unit weights
+    (e.g. sclite's), n_checks sentences are cross-checked first (see cross_check).
+    """
+    n_ins, n_del, n_sub, ref_lens = score_corpus(refs, hyps, weights, n_workers, chunk_size)
+    if n_checks and tuple(weights) != (1.0, 1.0, 1.0):
+        cross_check(refs, hyps, n_ins, n_del, n_sub, weights, n_checks)
+    return {
+        "corpus": aggregate(n_ins, n_del, n_sub, ref_lens, ["corpus"] * len(refs))["corpus"] if len(refs) else None,
+        "genres": aggregate(n_ins, n_del, n_sub, ref_lens, genres),
+        "documents": aggregate(n_ins, n_del, n_sub, ref_lens, documents),
+    }
+
+
+def print_report(report, max_documents=20):
+    def line(name, entry):
+        rate = f"{entry['error_rate']:.4f}" if entry["error_rate"] is not None else "N/A"
+        return f" * {name}: ER {rate} (ins {entry['ins']}, del {entry['del']}, sub {entry['sub']}, ref length {entry['ref_len']}, {entry['sentences']} sentences)"
+
+    if report["corpus"] is None:
+        print(" * Empty corpus")
+        return
+    print(line("corpus", report["corpus"]))
+    print(" --- Genres")
+    for name, entry in report["genres"].items():
+        print(line(name, entry))
+    print(" --- Documents (highest error rate first)")
+    documents = sorted(report["documents"].items(), key=lambda item: -(item[1]["error_rate"] or 0))
+    for name, entry in documents[:max_documents]:
+        print(line(name, entry))
+    print(" ---")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Corpus-level word error rate of system outputs, with per-genre and per-document breakdowns.")
+    parser.add_argument("--pair", nargs="+", action="append", metavar=("REF_FILE", "HYP_FILE"),
+                        help="Reference and hypothesis text files, optionally followed by a genre name (default: the reference directory). Repeatable.")
+    parser.add_argument("--table", default=None, help="CSV or spreadsheet file with reference and hypothesis columns")
+    parser.add_argument("--ref_column", default="Reference")
+    parser.add_argument("--hyp_column", default="Hypothesis")
+    parser.add_argument("--document_column", default=None)
+    parser.add_argument("--genre_column", default=None)
+    parser.add_argument("--sclite", action="store_true", help="Use the sclite weights (3, 3, 4) instead of unit weights")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core, 0: no pool)")
+    parser.add_argument("--chunk_size", type=int, default=2048, help="Sentences per task sent to a worker")
+    parser.add_argument("--checks", type=int, default=200, help="Sentences cross-checked against an independent DP with --sclite (0: none)")
+    parser.add_argument("--output_json", default=None)
+    args = parser.parse_args()
+
+    refs, hyps, documents, genres = [], [], [], []
+    for pair in args.pair or []:
+        if len(pair) not in (2, 3):
+            parser.error("--pair takes REF_FILE HYP_FILE [GENRE]")
+        for values, new_values in zip((refs, hyps, documents, genres), read_text_pair(*pair)):
+            values.extend(new_values)
+    if args.table:
+        for values, new_values in zip((refs, hyps, documents, genres), read_table(args.table, args.ref_column, args.hyp_column, args.document_column, args.genre_column)):
+            values.extend(new_values)
+    if not args.pair and not args.table:
+        parser.error("give at least one --pair or a --table")
+
+    start = time.perf_counter()
+    weights = SCLITE_WEIGHTS if args.sclite else (1.0, 1.0, 1.0)
+    report = corpus_edit_rate(refs, hyps, documents, genres, weights, args.workers, args.chunk_size, args.checks)
+    print(f" * Scored {len(refs)} sentences in {time.perf_counter() - start:.2f}s")
+    print_report(report)
+
+    if args.output_json:
+        with open(args.output_json, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report has been saved to '{args.output_json}'.")
+
+
+if __name__ == "__main__":
+    main()
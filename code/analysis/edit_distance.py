@@ -1,100 +1,934 @@
 
 import os
 import sys
-import torch
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
-__ed_dict__ = {}
+# Insertion, deletion and substitution weights used by sclite
+SCLITE_WEIGHTS = (3.0, 3.0, 4.0)
 
-def str_edit_distance(str_ref, str_hyp):
+# Op codes of the compact alignments: (ops, ref indices, hyp indices) arrays, with hyp index -1 for deletions
+OP_MATCH, OP_SUB, OP_INS, OP_DEL = 0, 1, 2, 3
+OP_NAMES = ('match', 'sub', 'ins', 'del')
 
-    global __ed_dict__
-    if len(__ed_dict__) > 100000:   # NOTE: avoid the dictionary size to increase too much
-        __ed_dict__ = {}
-
-    rtoks = str_ref.split()
-    htoks = str_hyp.split()
-    for t in rtoks + htoks:
-        if t not in __ed_dict__:
-            __ed_dict__[t] = len(__ed_dict__)
-    ref = torch.LongTensor( [__ed_dict__[t] for t in rtoks] )
-    hyp = torch.LongTensor( [__ed_dict__[t] for t in htoks] )
-
-    # These are 3, 3 and 4 in sclite if I remember well. However it does not change much the final error rate
-    ins_weight = 1.0
-    del_weight = 1.0
-    sub_weight = 1.0
 
+def _loop_ed_matrix(ref, hyp, ins_weight, del_weight, sub_weight):
+    # Reference implementation: the DP matrix filled cell by cell. torch is imported here only,
+    # so that the module itself loads with NumPy alone
+    import torch
+    ref = torch.LongTensor(list(ref))
+    hyp = torch.LongTensor(list(hyp))
     curr_x_size = ref.size(0)
     curr_y_size = hyp.size(0)
     tsr_ed_matrix = torch.FloatTensor(curr_x_size+1, curr_y_size+1).fill_(0)
+    # Borders: deleting the first i reference tokens, inserting the first j hypothesis tokens
     for i in range(1, curr_x_size+1):
-        tsr_ed_matrix[i,0] = float(i)
+        tsr_ed_matrix[i,0] = float(i) * del_weight
     for i in range(1, curr_y_size+1):
-        tsr_ed_matrix[0,i] = float(i)
+        tsr_ed_matrix[0,i] = float(i) * ins_weight
 
     for ij in range(curr_x_size*curr_y_size):
         i = (ij // curr_y_size)+1
         j = (ij % curr_y_size)+1
-                            
+
         tmp_weight = 0
         if ref[i-1] != hyp[j-1]:
-            tmp_weight = sub_weight 
+            tmp_weight = sub_weight
         tsr_ed_matrix[i,j] = min(tsr_ed_matrix[i-1,j] + del_weight, tsr_ed_matrix[i,j-1] + ins_weight, tsr_ed_matrix[i-1,j-1] + tmp_weight)
 
-    # Back-tracking for error rate computation
+    return tsr_ed_matrix.numpy()
+
+
+def _wavefront_ed_matrix(ref, hyp, ins_weight, del_weight, sub_weight):
+    """
+    DP matrix computed one anti-diagonal at a time: all the cells (i, j) with i + j = d
+    only depend on the diagonals d-1 and d-2, so each diagonal is a single vectorized
+    NumPy operation. Values are float32, like the loop kernel, so ties are broken the same way.
+    """
+    n = len(ref)
+    m = len(hyp)
+    ed_matrix = np.zeros((n+1, m+1), dtype=np.float32)
+    # Same weighted borders as the loop kernel
+    ed_matrix[:, 0] = np.arange(n+1, dtype=np.float32) * np.float32(del_weight)
+    ed_matrix[0, :] = np.arange(m+1, dtype=np.float32) * np.float32(ins_weight)
+    sub_cost = np.where(ref[:, None] != hyp[None, :], np.float32(sub_weight), np.float32(0))
+
+    for d in range(2, n+m+1):
+        i = np.arange(max(1, d-m), min(n, d-1)+1)
+        j = d - i
+        ed_matrix[i, j] = np.minimum(np.minimum(ed_matrix[i-1, j] + np.float32(del_weight), ed_matrix[i, j-1] + np.float32(ins_weight)),
+                                     ed_matrix[i-1, j-1] + sub_cost[i-1, j-1])
+    return ed_matrix
+
+
+def _backtrack(ed_matrix, ref, hyp, ins_weight, del_weight, sub_weight, with_alignment=True):
+    """
+    Back-tracking for error rate computation, on Python floats for fast scalar access.
+    Returns the counts and, if with_alignment, the compact alignment (ops, ref indices,
+    hyp indices); the path is walked in any case since the counts are read along it.
+
+    With unit weights the original tie-breaking on neighbour values is kept. Otherwise a
+    step is only taken if the current cell is the predecessor plus the weight of the step
+    (checked in float32, as the kernels compute it), preferring match/substitution, then
+    deletion, then insertion, so that the path is always an optimal one.
+    """
+    tsr_ed_matrix = ed_matrix.tolist()
     n_ins = 0
     n_del = 0
     n_sub = 0
 
-    alignement = []
-    back_track_i = curr_x_size
-    back_track_j = curr_y_size
+    unit = _unit_weights(ins_weight, del_weight, sub_weight)
+    if not unit and ed_matrix.shape[0] > 1 and ed_matrix.shape[1] > 1:
+        mismatch = np.asarray(ref)[:, None] != np.asarray(hyp)[None, :]
+        cur = ed_matrix[1:, 1:]
+        diag_ok = (cur == ed_matrix[:-1, :-1] + np.where(mismatch, np.float32(sub_weight), np.float32(0))).tolist()
+        del_ok = (cur == ed_matrix[:-1, 1:] + np.float32(del_weight)).tolist()
+        mismatch = mismatch.tolist()
+
+    ops, ref_indices, hyp_indices = [], [], []
+    back_track_i = len(tsr_ed_matrix) - 1
+    back_track_j = len(tsr_ed_matrix[0]) - 1
     while back_track_i > 0 and back_track_j > 0:
-        
+
         i = back_track_i
         j = back_track_j
-        tmp_weight = 0
-        if tsr_ed_matrix[i-1,j-1] != tsr_ed_matrix[i,j]:
-            tmp_weight = sub_weight
-
-        if tsr_ed_matrix[i-1,j] < tsr_ed_matrix[i,j-1]:
-            if tsr_ed_matrix[i-1,j] < tsr_ed_matrix[i-1,j-1]:
-                alignement.append( ('del', back_track_i-1, None) )
-                n_del += 1
-                back_track_i -= 1
+        if not unit:
+            if diag_ok[i-1][j-1]:
+                op = OP_SUB if mismatch[i-1][j-1] else OP_MATCH
+            elif del_ok[i-1][j-1]:
+                op = OP_DEL
             else:
-                back_track_i -= 1
-                back_track_j -= 1
-                alignement.append( ('match', back_track_i, back_track_j) )
-                if tmp_weight > 0:
-                    n_sub += 1
-                    alignement[-1] = ('sub', alignement[-1][1], alignement[-1][2])
-
-        else:   # tsr_ed_matrix[i-1,j] >= tsr_ed_matrix[i,j-1]
-            if tsr_ed_matrix[i,j-1] < tsr_ed_matrix[i-1,j-1]:
-                alignement.append( ('ins', back_track_i-1, back_track_j-1) )
-                n_ins += 1
-                back_track_j -= 1
-            else:
-                back_track_i -= 1
-                back_track_j -= 1
-                alignement.append( ('match', back_track_i, back_track_j) )
-                if tmp_weight > 0:
-                    n_sub += 1
-                    alignement[-1] = ('sub', alignement[-1][1], alignement[-1][2])
+                op = OP_INS
+        else:
+            tmp_weight = 0
+            if tsr_ed_matrix[i-1][j-1] != tsr_ed_matrix[i][j]:
+                tmp_weight = sub_weight
+
+            if tsr_ed_matrix[i-1][j] < tsr_ed_matrix[i][j-1]:
+                if tsr_ed_matrix[i-1][j] < tsr_ed_matrix[i-1][j-1]:
+                    op = OP_DEL
+                else:
+                    op = OP_SUB if tmp_weight > 0 else OP_MATCH
+            else:   # tsr_ed_matrix[i-1][j] >= tsr_ed_matrix[i][j-1]
+                if tsr_ed_matrix[i][j-1] < tsr_ed_matrix[i-1][j-1]:
+                    op = OP_INS
+                else:
+                    op = OP_SUB if tmp_weight > 0 else OP_MATCH
+
+        if op == OP_DEL:
+            n_del += 1
+            back_track_i -= 1
+        elif op == OP_INS:
+            n_ins += 1
+            back_track_j -= 1
+        else:
+            n_sub += op == OP_SUB
+            back_track_i -= 1
+            back_track_j -= 1
+        if with_alignment:
+            # del: (i-1, None), ins: (i-1, j-1), match/sub: (i-1, j-1)
+            ops.append(op)
+            ref_indices.append(i - 1)
+            hyp_indices.append(-1 if op == OP_DEL else j - 1)
+
+    n_del += back_track_i
+    n_ins += back_track_j
+    if not with_alignment:
+        return n_ins, n_del, n_sub, None
+
+    ops.extend([OP_DEL] * back_track_i + [OP_INS] * back_track_j)
+    ref_indices.extend(list(range(back_track_i - 1, -1, -1)) + [-1] * back_track_j)
+    hyp_indices.extend([-1] * back_track_i + list(range(back_track_j - 1, -1, -1)))
+    alignment = (np.array(ops[::-1], dtype=np.int8), np.array(ref_indices[::-1], dtype=np.int32), np.array(hyp_indices[::-1], dtype=np.int32))
+    return n_ins, n_del, n_sub, alignment
+
+
+def alignment_to_tuples(alignment):
+    # Compact alignment to the list of ('match'|'sub'|'ins'|'del', ref index, hyp index or None) tuples
+    ops, ref_indices, hyp_indices = (np.asarray(values).tolist() for values in alignment)
+    return [(OP_NAMES[op], r, h if h >= 0 else None) for op, r, h in zip(ops, ref_indices, hyp_indices)]
+
+
+def render_alignment(alignment, ref_tokens, hyp_tokens):
+    """One 'op) r:<ref token>, h:<hyp token or ->' line per step of a compact or tuple alignment."""
+    if isinstance(alignment, tuple):
+        alignment = alignment_to_tuples(alignment)
+    return ['{}) r:{}, h:{}'.format(op, ref_tokens[r], hyp_tokens[h] if h is not None else '-') for op, r, h in alignment]
+
+
+class TokenInterner:
+    """
+    Maps tokens to consecutive int ids. The mapping lives as long as the instance (one
+    pair, one batch, one corpus), so there is no global vocabulary to grow or reset, and
+    access is locked so that one instance can be shared by several threads.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def encode(self, seq):
+        # A string is split on whitespace; integer sequences are already encoded
+        if isinstance(seq, str):
+            seq = seq.split()
+        elif len(seq) == 0 or not isinstance(seq[0], str):
+            return list(seq)
+        with self._lock:
+            return [self._ids.setdefault(t, len(self._ids)) for t in seq]
+
+
+def str_edit_distance(str_ref, str_hyp, ins_weight=1.0, del_weight=1.0, sub_weight=1.0, kernel='wavefront', alignment='list'):
+    """
+    Word-level edit distance between a reference and a hypothesis string.
+    Returns (n_ins, n_del, n_sub, ref_len, alignment).
+
+    The weights are 1, 1, 1 by default; sclite uses 3, 3, 4 (SCLITE_WEIGHTS), which
+    does not change much the final error rate. Counts are read on a path of minimal
+    weighted cost, whatever the weights. kernel='loop' selects the original
+    cell-by-cell implementation, kept as a reference.
+
+    alignment='list' returns the alignment as a list of (op name, ref index, hyp index)
+    tuples, alignment='ops' as compact (ops, ref indices, hyp indices) int arrays (see
+    render_alignment), and alignment=None skips it.
+    """
+    if alignment not in ('list', 'ops', None):
+        raise ValueError("Unknown alignment format '{}'".format(alignment))
+    # Ids only need to be consistent within the pair
+    interner = TokenInterner()
+    rtoks = str_ref.split()
+    htoks = str_hyp.split()
+    n_ins, n_del, n_sub, ops = _ids_edit_distance(interner.encode(rtoks), interner.encode(htoks), ins_weight, del_weight, sub_weight, kernel, alignment)
+    return (n_ins, n_del, n_sub, len(rtoks), ops)
+
+
+def _ids_edit_distance(ref_ids, hyp_ids, ins_weight, del_weight, sub_weight, kernel, alignment):
+    # Counts and alignment of two id sequences with the selected kernel
+    if kernel == 'loop':
+        ed_matrix = _loop_ed_matrix(ref_ids, hyp_ids, ins_weight, del_weight, sub_weight)
+    elif kernel == 'wavefront':
+        ref = np.asarray(ref_ids, dtype=np.int64)
+        hyp = np.asarray(hyp_ids, dtype=np.int64)
+        ed_matrix = _wavefront_ed_matrix(ref, hyp, ins_weight, del_weight, sub_weight)
+    else:
+        raise ValueError("Unknown edit distance kernel '{}'".format(kernel))
+
+    n_ins, n_del, n_sub, ops = _backtrack(ed_matrix, ref_ids, hyp_ids, ins_weight, del_weight, sub_weight, with_alignment=alignment is not None)
+    if alignment == 'list':
+        ops = alignment_to_tuples(ops)
+    return n_ins, n_del, n_sub, ops
+
+
+def _encode_batch(refs, hyps, interner=None):
+    # Token strings are mapped to ids with a vocabulary local to the batch, unless an interner is shared
+    interner = interner if interner is not None else TokenInterner()
+    return [interner.encode(r) for r in refs], [interner.encode(h) for h in hyps]
+
+
+def _batch_ed_matrices(refs, hyps, ins_weight, del_weight, sub_weight):
+    """
+    DP matrices of a whole batch in one (batch, max_ref+1, max_hyp+1) array, filled one
+    anti-diagonal at a time for all pairs together. Padding positions never match each
+    other (-1 in references, -2 in hypotheses) and cells beyond the real lengths of a
+    pair are never read by its real cells. Returns the matrices and the (batch, max_ref,
+    max_hyp) token mismatch mask, which the weighted backtrace needs.
+    """
+    n_pairs = len(refs)
+    max_n = max((len(r) for r in refs), default=0)
+    max_m = max((len(h) for h in hyps), default=0)
+    ref_ids = np.full((n_pairs, max_n), -1, dtype=np.int64)
+    hyp_ids = np.full((n_pairs, max_m), -2, dtype=np.int64)
+    for b, (r, h) in enumerate(zip(refs, hyps)):
+        ref_ids[b, :len(r)] = r
+        hyp_ids[b, :len(h)] = h
+
+    ed_matrix = np.zeros((n_pairs, max_n+1, max_m+1), dtype=np.float32)
+    ed_matrix[:, :, 0] = np.arange(max_n+1, dtype=np.float32) * np.float32(del_weight)
+    ed_matrix[:, 0, :] = np.arange(max_m+1, dtype=np.float32) * np.float32(ins_weight)
+    mismatch = ref_ids[:, :, None] != hyp_ids[:, None, :]
+    sub_cost = np.where(mismatch, np.float32(sub_weight), np.float32(0))
+
+    for d in range(2, max_n+max_m+1):
+        i = np.arange(max(1, d-max_m), min(max_n, d-1)+1)
+        j = d - i
+        ed_matrix[:, i, j] = np.minimum(np.minimum(ed_matrix[:, i-1, j] + np.float32(del_weight), ed_matrix[:, i, j-1] + np.float32(ins_weight)),
+                                        ed_matrix[:, i-1, j-1] + sub_cost[:, i-1, j-1])
+    return ed_matrix, mismatch
+
+
+def _batch_ed_matrices_torch(refs, hyps, ins_weight, del_weight, sub_weight, device='cpu'):
+    """
+    Same as _batch_ed_matrices with torch tensors, e.g. to fill the matrices on a GPU;
+    torch is imported on first use only. Returns NumPy arrays for the backtrace.
+    """
+    import torch
+    n_pairs = len(refs)
+    max_n = max((len(r) for r in refs), default=0)
+    max_m = max((len(h) for h in hyps), default=0)
+    ref_ids = torch.full((n_pairs, max_n), -1, dtype=torch.int64)
+    hyp_ids = torch.full((n_pairs, max_m), -2, dtype=torch.int64)
+    for b, (r, h) in enumerate(zip(refs, hyps)):
+        ref_ids[b, :len(r)] = torch.as_tensor(np.asarray(r, dtype=np.int64))
+        hyp_ids[b, :len(h)] = torch.as_tensor(np.asarray(h, dtype=np.int64))
+    ref_ids = ref_ids.to(device)
+    hyp_ids = hyp_ids.to(device)
+
+    ed_matrix = torch.zeros((n_pairs, max_n+1, max_m+1), dtype=torch.float32, device=device)
+    ed_matrix[:, :, 0] = torch.arange(max_n+1, dtype=torch.float32, device=device) * del_weight
+    ed_matrix[:, 0, :] = torch.arange(max_m+1, dtype=torch.float32, device=device) * ins_weight
+    mismatch = ref_ids[:, :, None] != hyp_ids[:, None, :]
+    sub_cost = mismatch.to(torch.float32) * sub_weight
+
+    for d in range(2, max_n+max_m+1):
+        i = torch.arange(max(1, d-max_m), min(max_n, d-1)+1, device=device)
+        j = d - i
+        ed_matrix[:, i, j] = torch.minimum(torch.minimum(ed_matrix[:, i-1, j] + del_weight, ed_matrix[:, i, j-1] + ins_weight),
+                                           ed_matrix[:, i-1, j-1] + sub_cost[:, i-1, j-1])
+    return ed_matrix.cpu().numpy(), mismatch.cpu().numpy()
+
+
+def _batch_backtrack(ed_matrix, mismatch, ref_lens, hyp_lens, ins_weight, del_weight, sub_weight, with_alignment):
+    """
+    Back-tracking of all the pairs at once, one step per iteration, with the same
+    tie-breaking as _backtrack. Returns the counts and, if requested, the per-step
+    (op, ref index, hyp index) arrays of every pair, in reverse order.
+    """
+    n_pairs = ed_matrix.shape[0]
+    unit = _unit_weights(ins_weight, del_weight, sub_weight)
+    # The clipped lookups below need at least two rows and columns, even when all references or hypotheses are empty
+    if ed_matrix.shape[1] < 2 or ed_matrix.shape[2] < 2:
+        ed_matrix = np.pad(ed_matrix, ((0, 0), (0, max(0, 2 - ed_matrix.shape[1])), (0, max(0, 2 - ed_matrix.shape[2]))), constant_values=np.inf)
+        mismatch = np.pad(mismatch, ((0, 0), (0, max(0, 1 - mismatch.shape[1])), (0, max(0, 1 - mismatch.shape[2]))), constant_values=True)
+    rows = np.arange(n_pairs)
+    i = np.asarray(ref_lens, dtype=np.int64).copy()
+    j = np.asarray(hyp_lens, dtype=np.int64).copy()
+    n_ins = np.zeros(n_pairs, dtype=np.int64)
+    n_del = np.zeros(n_pairs, dtype=np.int64)
+    n_sub = np.zeros(n_pairs, dtype=np.int64)
+    steps = []
+
+    while True:
+        active = (i > 0) | (j > 0)
+        if not active.any():
+            break
+        both = (i > 0) & (j > 0)
+        # Clip the indices of finished pairs so that the lookups stay valid
+        ci = np.maximum(i, 1)
+        cj = np.maximum(j, 1)
+        cur = ed_matrix[rows, ci, cj]
+        up = ed_matrix[rows, ci-1, cj]
+        left = ed_matrix[rows, ci, cj-1]
+        diag = ed_matrix[rows, ci-1, cj-1]
+
+        if unit:
+            up_first = up < left
+            is_del = (both & up_first & (up < diag)) | ((i > 0) & (j == 0))
+            is_ins = (both & ~up_first & (left < diag)) | ((i == 0) & (j > 0))
+            is_diag = both & ~is_del & ~is_ins
+            is_sub = is_diag & (diag != cur) & (sub_weight > 0)
+        else:
+            # Only steps whose weight accounts for the current cell, as in _backtrack
+            differs = mismatch[rows, ci-1, cj-1]
+            is_diag = both & (cur == diag + np.where(differs, np.float32(sub_weight), np.float32(0)))
+            is_del = (both & ~is_diag & (cur == up + np.float32(del_weight))) | ((i > 0) & (j == 0))
+            is_ins = (both & ~is_diag & ~is_del) | ((i == 0) & (j > 0))
+            is_sub = is_diag & differs
+
+        if with_alignment:
+            op = np.where(is_del, OP_DEL, np.where(is_ins, OP_INS, np.where(is_sub, OP_SUB, OP_MATCH)))
+            # del: (i-1, None); ins: (i-1, j-1); match/sub: (i-1, j-1) after moving diagonally
+            ref_index = i - 1
+            hyp_index = np.where(is_del, -1, j - 1)
+            steps.append((active, op, ref_index, hyp_index))
+
+        n_del += is_del
+        n_ins += is_ins
+        n_sub += is_sub
+        i -= is_del | is_diag
+        j -= is_ins | is_diag
+
+    return n_ins, n_del, n_sub, steps
+
+
+def _steps_to_ops(steps, n_pairs):
+    # Per-pair compact alignments (ops, ref indices, hyp indices), as str_edit_distance(alignment='ops')
+    if not steps:
+        empty = (np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        return [empty] * n_pairs
+    active, op, ref_index, hyp_index = (np.stack(arrays) for arrays in zip(*steps))
+    alignments = []
+    for b in range(n_pairs):
+        taken = active[::-1, b]
+        alignments.append((op[::-1, b][taken].astype(np.int8), ref_index[::-1, b][taken].astype(np.int32), hyp_index[::-1, b][taken].astype(np.int32)))
+    return alignments
+
+
+def batch_edit_distance(refs, hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0, alignments=False, batch_size=256, max_distance=None, backend='numpy', device='cpu'):
+    """
+    Edit distances of many reference/hypothesis pairs in a few vectorized DPs.
+
+    refs and hyps are lists of strings (split on whitespace) or of integer token sequences.
+    Pairs are sorted by length and processed batch_size at a time, each batch padded into
+    a single 3D DP array. Returns (n_ins, n_del, n_sub, ref_lens, alignments): four int
+    arrays with one value per pair, and the list of per-pair alignments, as tuple lists
+    with alignments=True, as compact arrays with alignments='ops' (None otherwise).
+    Counts and alignments are identical to calling str_edit_distance on each pair.
+
+    With max_distance, pairs whose weighted distance exceeds it are discarded by the banded
+    DP first; their counts are -1 and their alignment None.
+
+    backend='torch' fills the DP matrices with torch on device (torch is only imported
+    then); the backtrace always runs in NumPy.
+    """
+    if backend not in ('numpy', 'torch'):
+        raise ValueError("Unknown edit distance backend '{}'".format(backend))
+    if len(refs) != len(hyps):
+        raise ValueError('Got {} references and {} hypotheses'.format(len(refs), len(hyps)))
+    ref_seqs, hyp_seqs = _encode_batch(refs, hyps)
+    n_pairs = len(ref_seqs)
+    ref_lens = np.array([len(r) for r in ref_seqs], dtype=np.int64)
+    hyp_lens = np.array([len(h) for h in hyp_seqs], dtype=np.int64)
+    n_ins = np.zeros(n_pairs, dtype=np.int64)
+    n_del = np.zeros(n_pairs, dtype=np.int64)
+    n_sub = np.zeros(n_pairs, dtype=np.int64)
+    all_alignments = [None] * n_pairs if alignments else None
+
+    # Pairs of similar size go together to keep the padding small
+    order = np.argsort(np.maximum(ref_lens, hyp_lens), kind='stable')
+    if max_distance is not None:
+        within = np.isfinite(_banded_distances(ref_seqs, hyp_seqs, max_distance, ins_weight, del_weight, sub_weight))
+        n_ins[~within] = n_del[~within] = n_sub[~within] = -1
+        order = order[within[order]]
+
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start+batch_size]
+        batch_refs = [ref_seqs[b] for b in batch]
+        batch_hyps = [hyp_seqs[b] for b in batch]
+        if backend == 'torch':
+            ed_matrix, mismatch = _batch_ed_matrices_torch(batch_refs, batch_hyps, ins_weight, del_weight, sub_weight, device)
+        else:
+            ed_matrix, mismatch = _batch_ed_matrices(batch_refs, batch_hyps, ins_weight, del_weight, sub_weight)
+        b_ins, b_del, b_sub, steps = _batch_backtrack(ed_matrix, mismatch, ref_lens[batch], hyp_lens[batch], ins_weight, del_weight, sub_weight, alignments)
+        n_ins[batch] = b_ins
+        n_del[batch] = b_del
+        n_sub[batch] = b_sub
+        if alignments:
+            for b, alignment in zip(batch, _steps_to_ops(steps, len(batch))):
+                all_alignments[b] = alignment if alignments == 'ops' else alignment_to_tuples(alignment)
+
+    return n_ins, n_del, n_sub, ref_lens, all_alignments
+
 
-    while back_track_i > 0:
-        alignement.append( ('del', back_track_i-1, None) )
-        back_track_i -= 1
-        n_del += 1
+def _banded_distances(ref_seqs, hyp_seqs, max_distance, ins_weight, del_weight, sub_weight):
+    """
+    Banded DP of many pairs at once. The matrix of each pair is stored in band coordinates,
+    cell (i, j) in column o = j - i + band, so one row of every pair is a (pairs, 2 * band + 1)
+    array: the cell above (i-1, j) is column o+1 of the previous row, the diagonal cell
+    (i-1, j-1) column o, and the cell on the left (i, j-1) column o-1 of the same row.
+    Pairs leave the working set when their last row is reached or when their row minimum
+    exceeds max_distance.
+    """
+    n_pairs = len(ref_seqs)
+    distances = np.full(n_pairs, np.inf)
+    # Every step off the main diagonal is an insertion or a deletion
+    step_cost = min(ins_weight, del_weight)
+    max_len = max([len(r) for r in ref_seqs] + [len(h) for h in hyp_seqs] + [0])
+    band = min(int(max_distance // step_cost), max_len) if step_cost > 0 else max_len
 
-    while back_track_j > 0:
-        alignement.append( ('ins', back_track_i-1, back_track_j-1) )
-        back_track_j -= 1
-        n_ins += 1
+    ref_lens = np.array([len(r) for r in ref_seqs], dtype=np.int64)
+    hyp_lens = np.array([len(h) for h in hyp_seqs], dtype=np.int64)
+    # Pairs whose length difference alone exceeds the band can never be within max_distance
+    alive = np.flatnonzero(np.abs(ref_lens - hyp_lens) <= band)
+    if len(alive) == 0:
+        return distances
+
+    max_n = int(ref_lens[alive].max())
+    max_m = int(hyp_lens[alive].max())
+    ref_ids = np.full((n_pairs, max_n+1), -1, dtype=np.int64)
+    hyp_ids = np.full((n_pairs, max_m+1), -2, dtype=np.int64)
+    for b in alive:
+        ref_ids[b, :ref_lens[b]] = ref_seqs[b]
+        hyp_ids[b, :hyp_lens[b]] = hyp_seqs[b]
+
+    offsets = np.arange(2*band+1)
+    # Row 0: D[0][j] = j * ins
+    j = offsets - band
+    prev = np.where((j >= 0)[None, :] & (j[None, :] <= hyp_lens[alive, None]), j.astype(np.float64)[None, :] * ins_weight, np.inf)
+
+    # Pairs with an empty reference end at row 0
+    done = ref_lens[alive] == 0
+    distances[alive[done]] = prev[done, band + hyp_lens[alive[done]]]
+    prev = prev[~done]
+    alive = alive[~done]
+
+    for i in range(1, max_n+1):
+        if len(alive) == 0:
+            break
+        j = i - band + offsets
+        valid = (j >= 0)[None, :] & (j[None, :] <= hyp_lens[alive, None])
+        # Deletion from the cell above, substitution/match from the diagonal cell
+        up = np.concatenate((prev[:, 1:], np.full((len(alive), 1), np.inf)), axis=1)
+        hyp_tokens = hyp_ids[alive][:, np.clip(j-1, 0, max_m)]
+        sub_cost = np.where(hyp_tokens != ref_ids[alive, i-1][:, None], sub_weight, 0.0)
+        cur = np.minimum(up + del_weight, prev + sub_cost)
+        # First column of the matrix: D[i][0] = i * del
+        if i <= band:
+            cur[:, band - i] = i * del_weight
+        cur[~valid] = np.inf
+        # Insertions chain along the row: cur[o] = min over p <= o of (cur[p] + (o - p) * ins)
+        cur = np.minimum.accumulate(cur - offsets * ins_weight, axis=1) + offsets * ins_weight
+        cur[~valid] = np.inf
+
+        # Pairs reaching their last row are done, pairs above max_distance are dropped
+        finished = ref_lens[alive] == i
+        distances[alive[finished]] = cur[finished, band + hyp_lens[alive[finished]] - i]
+        keep = ~finished & (cur.min(axis=1) <= max_distance)
+        prev = cur[keep]
+        alive = alive[keep]
+
+    distances[distances > max_distance] = np.inf
+    return distances
+
+
+def banded_edit_distance(ref, hyp, max_distance, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """
+    Weighted edit distance of two token sequences if it is at most max_distance, None otherwise.
+
+    Same DP matrix as str_edit_distance, but only the diagonal band that a path of cost
+    <= max_distance can cross is computed (Ukkonen): every step off the main diagonal costs
+    at least min(ins, del), borders included. The computation
+    stops as soon as the minimum of a row exceeds max_distance, since the cost never
+    decreases along a path.
+    """
+    ref_seqs, hyp_seqs = _encode_batch([ref], [hyp])
+    distance = _banded_distances(ref_seqs, hyp_seqs, max_distance, ins_weight, del_weight, sub_weight)[0]
+    return float(distance) if np.isfinite(distance) else None
+
+
+def batch_banded_edit_distance(refs, hyps, max_distance, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """Per-pair banded distances as a float array, np.inf for the pairs exceeding max_distance."""
+    if len(refs) != len(hyps):
+        raise ValueError('Got {} references and {} hypotheses'.format(len(refs), len(hyps)))
+    ref_seqs, hyp_seqs = _encode_batch(refs, hyps)
+    return _banded_distances(ref_seqs, hyp_seqs, max_distance, ins_weight, del_weight, sub_weight)
+
+
+def bit_parallel_distance(ref, hyp):
+    """
+    Unit-cost edit distance between two token sequences with the bit-parallel
+    algorithm of Myers (1999) in the formulation of Hyyro (2001).
+
+    One column of the DP matrix is encoded as two bit vectors of vertical +1/-1
+    deltas, and each hypothesis token updates the whole column with a handful of
+    bitwise operations, i.e. O(len(hyp) * ceil(len(ref) / 64)) word operations.
+    Python integers are arbitrary-precision, so the bit vectors span as many
+    machine words as the reference needs, carries included.
+    """
+    m = len(ref)
+    if m == 0:
+        return len(hyp)
+    mask = (1 << m) - 1
+    high_bit = 1 << (m - 1)
+
+    # Positions of each token in the reference
+    peq = {}
+    for position, token in enumerate(ref):
+        peq[token] = peq.get(token, 0) | (1 << position)
+
+    pv = mask
+    mv = 0
+    score = m
+    for token in hyp:
+        eq = peq.get(token, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high_bit:
+            score += 1
+        elif mh & high_bit:
+            score -= 1
+        # The first row of the matrix grows by one at each column
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
+def _unit_weights(ins_weight, del_weight, sub_weight):
+    return ins_weight == 1 and del_weight == 1 and sub_weight == 1
+
+
+def str_word_errors(str_ref, str_hyp, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """
+    Number of errors (ins + del + sub) and reference length, without the alignment.
+    With unit weights the number of errors is the edit distance itself and the
+    bit-parallel algorithm is used; otherwise the errors are counted on the DP path.
+    """
+    rtoks = str_ref.split()
+    htoks = str_hyp.split()
+    if _unit_weights(ins_weight, del_weight, sub_weight):
+        return bit_parallel_distance(rtoks, htoks), len(rtoks)
+    n_ins, n_del, n_sub, ref_len, _ = str_edit_distance(str_ref, str_hyp, ins_weight, del_weight, sub_weight)
+    return n_ins + n_del + n_sub, ref_len
+
+
+def batch_word_errors(refs, hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """
+    Per-pair number of errors and reference lengths (two int arrays) for lists of strings
+    or token sequences; bit-parallel with unit weights, batch_edit_distance otherwise.
+    """
+    if len(refs) != len(hyps):
+        raise ValueError('Got {} references and {} hypotheses'.format(len(refs), len(hyps)))
+    if not _unit_weights(ins_weight, del_weight, sub_weight):
+        n_ins, n_del, n_sub, ref_lens, _ = batch_edit_distance(refs, hyps, ins_weight, del_weight, sub_weight)
+        return n_ins + n_del + n_sub, ref_lens
+
+    errors = np.zeros(len(refs), dtype=np.int64)
+    ref_lens = np.zeros(len(refs), dtype=np.int64)
+    for b, (ref, hyp) in enumerate(zip(refs, hyps)):
+        ref = ref.split() if isinstance(ref, str) else ref
+        hyp = hyp.split() if isinstance(hyp, str) else hyp
+        errors[b] = bit_parallel_distance(ref, hyp)
+        ref_lens[b] = len(ref)
+    return errors, ref_lens
+
+
+def word_error_rate(refs, hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    # Corpus-level error rate: total errors over total reference length
+    errors, ref_lens = batch_word_errors(refs, hyps, ins_weight, del_weight, sub_weight)
+    return errors.sum() / ref_lens.sum() if ref_lens.sum() > 0 else float('nan')
+
+
+def corpus_edit_distance(refs, hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0, n_threads=None, chunk_size=1024):
+    """
+    (n_ins, n_del, n_sub, ref_lens) of every pair of a corpus, as batch_edit_distance, with
+    chunks of chunk_size pairs scored by a pool of n_threads threads (default: one per core).
+    The NumPy DP kernels release the GIL, so the threads run them in parallel. The corpus
+    is encoded once with a single TokenInterner, which the threads never write to.
+    """
+    if len(refs) != len(hyps):
+        raise ValueError('Got {} references and {} hypotheses'.format(len(refs), len(hyps)))
+    interner = TokenInterner()
+    ref_seqs, hyp_seqs = _encode_batch(refs, hyps, interner)
+    # Chunks are cut from the length-sorted corpus, so that each one pads little
+    order = np.argsort([max(len(r), len(h)) for r, h in zip(ref_seqs, hyp_seqs)], kind='stable')
+    chunks = [order[start:start+chunk_size] for start in range(0, len(order), chunk_size)]
+
+    def score_chunk(chunk):
+        return batch_edit_distance([ref_seqs[b] for b in chunk], [hyp_seqs[b] for b in chunk], ins_weight, del_weight, sub_weight)[:4]
+
+    counts = tuple(np.zeros(len(refs), dtype=np.int64) for _ in range(4))
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as executor:
+        for chunk, chunk_counts in zip(chunks, executor.map(score_chunk, chunks)):
+            for array, values in zip(counts, chunk_counts):
+                array[chunk] = values
+    return counts
+
+
+def _build_tries(hyp_groups):
+    """
+    One token trie per group of hypotheses; a node is [children by token, numbers of the
+    hypotheses ending there], hypotheses being numbered across groups.
+    """
+    roots = []
+    number = 0
+    for hyps in hyp_groups:
+        root = [{}, []]
+        for hyp in hyps:
+            node = root
+            for token in hyp:
+                node = node[0].setdefault(token, [{}, []])
+            node[1].append(number)
+            number += 1
+        roots.append(root)
+    return roots
+
+
+def _flatten_tries(roots):
+    """
+    The tries depth by depth: for each depth d >= 1 the (parent positions at depth d-1,
+    tokens, groups) of its nodes, and for each depth the (position, hypothesis number) of
+    the hypotheses ending there. Depth 0 holds the roots, at the position of their group.
+    """
+    levels = []
+    ends = [[(group, n) for group, root in enumerate(roots) for n in root[1]]]
+    frontier = [(group, group, root) for group, root in enumerate(roots)]
+    while True:
+        parents, tokens, groups, level_ends, next_frontier = [], [], [], [], []
+        for group, position, node in frontier:
+            for token, child in node[0].items():
+                child_position = len(parents)
+                parents.append(position)
+                tokens.append(token)
+                groups.append(group)
+                level_ends.extend((child_position, n) for n in child[1])
+                next_frontier.append((group, child_position, child))
+        if not parents:
+            break
+        levels.append((np.array(parents, dtype=np.int64), tokens, np.array(groups, dtype=np.int64)))
+        ends.append(level_ends)
+        frontier = next_frontier
+    return levels, ends
+
+
+def _bit_parallel_trie(rtoks, root, distances):
+    # Unit-cost distances of the hypotheses of one trie, depth first with the column update of bit_parallel_distance
+    n = len(rtoks)
+    if n == 0:
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            for number in node[1]:
+                distances[number] = depth
+            stack.extend((child, depth + 1) for child in node[0].values())
+        return
+    mask = (1 << n) - 1
+    high_bit = 1 << (n - 1)
+    peq = {}
+    for position, token in enumerate(rtoks):
+        peq[token] = peq.get(token, 0) | (1 << position)
+
+    stack = [(root, mask, 0, n)]
+    while stack:
+        node, pv, mv, score = stack.pop()
+        for number in node[1]:
+            distances[number] = score
+        for token, child in node[0].items():
+            eq = peq.get(token, 0)
+            xv = eq | mv
+            xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            child_score = score + 1 if ph & high_bit else score - 1 if mh & high_bit else score
+            ph = ((ph << 1) | 1) & mask
+            mh = (mh << 1) & mask
+            stack.append((child, mh | (~(xv | ph) & mask), ph & xv, child_score))
+
+
+def _trie_distances(ref_seqs, hyp_groups, ins_weight, del_weight, sub_weight):
+    # Distances of every hypothesis of hyp_groups[g] to ref_seqs[g], numbered across groups
+    distances = np.zeros(sum(len(hyps) for hyps in hyp_groups))
+    roots = _build_tries(hyp_groups)
+    if _unit_weights(ins_weight, del_weight, sub_weight):
+        for ref, root in zip(ref_seqs, roots):
+            _bit_parallel_trie(ref, root, distances)
+        return distances
+
+    # Weighted: the nodes of all the tries at one depth are updated together, one column each
+    levels, ends = _flatten_tries(roots)
+    interner = TokenInterner()
+    ref_lens = np.array([len(ref) for ref in ref_seqs], dtype=np.int64)
+    max_n = int(ref_lens.max(initial=0))
+    ref_ids = np.full((len(ref_seqs), max_n), -1, dtype=np.int64)
+    for g, ref in enumerate(ref_seqs):
+        ref_ids[g, :len(ref)] = interner.encode(ref)
+
+    positions = np.arange(max_n+1, dtype=np.float64)
+    # Depth 0: the border of the DP matrix, deleting the first i reference tokens
+    columns = np.tile(positions * del_weight, (len(ref_seqs), 1))
+    groups = np.arange(len(ref_seqs))
+    for depth in range(len(levels) + 1):
+        if depth > 0:
+            parents, tokens, groups = levels[depth-1]
+            token_ids = np.array(interner.encode(tokens), dtype=np.int64)
+            previous = columns[parents]
+            candidates = np.empty_like(previous)
+            # Row 0: inserting the first depth hypothesis tokens
+            candidates[:, 0] = depth * ins_weight
+            sub_cost = np.where(ref_ids[groups] != token_ids[:, None], sub_weight, 0.0)
+            candidates[:, 1:] = np.minimum(previous[:, 1:] + ins_weight, previous[:, :-1] + sub_cost)
+            # Deletions chain down the column: cell i = min over p <= i of (candidates[p] + (i - p) * del)
+            columns = np.minimum.accumulate(candidates - positions * del_weight, axis=1) + positions * del_weight
+        for position, number in ends[depth]:
+            distances[number] = columns[position, ref_lens[groups[position]]]
+    return distances
+
+
+def trie_edit_distances(ref, hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """
+    Edit distances of one reference to many hypotheses (e.g. the outputs of several systems
+    or checkpoints). The hypotheses are put into a token trie and one DP column (all the
+    reference positions, for one hypothesis prefix) is computed per trie node, so that a
+    prefix shared by k hypotheses is scored once instead of k times.
+
+    With unit weights a column is the bit-parallel state of bit_parallel_distance and the
+    trie is walked depth first. Otherwise the columns are NumPy rows, all the nodes of a
+    depth are updated together and the deletion chain along the reference is resolved
+    with a cumulative minimum.
+
+    Returns a float array with one distance per hypothesis, the weighted distance of
+    str_edit_distance (computed in float64 here, so non-integer weights may differ in the
+    last float32 digits).
+    """
+    rtoks = ref.split() if isinstance(ref, str) else list(ref)
+    hyps = [hyp.split() if isinstance(hyp, str) else list(hyp) for hyp in hyps]
+    return _trie_distances([rtoks], [hyps], ins_weight, del_weight, sub_weight)
+
+
+def multi_system_edit_distances(refs, system_hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """
+    trie_edit_distances over a corpus, with the tries of all the references advancing
+    together: system_hyps holds one list of hypotheses per system, aligned with refs.
+    Returns a (systems, sentences) float array of distances.
+    """
+    for hyps in system_hyps:
+        if len(hyps) != len(refs):
+            raise ValueError('Got {} references and {} hypotheses'.format(len(refs), len(hyps)))
+    ref_seqs = [ref.split() if isinstance(ref, str) else list(ref) for ref in refs]
+    hyp_groups = [[hyps[s].split() if isinstance(hyps[s], str) else list(hyps[s]) for hyps in system_hyps] for s in range(len(refs))]
+    distances = _trie_distances(ref_seqs, hyp_groups, ins_weight, del_weight, sub_weight)
+    return distances.reshape(len(refs), len(system_hyps)).T
+
+
+def normalize_chars(text):
+    # NFC form and single spaces, so that the same characters always give the same codepoints
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def codepoints(text):
+    """Codepoints of the normalized text as an int32 array (spaces included)."""
+    return np.frombuffer(normalize_chars(text).encode('utf-32-le'), dtype=np.int32)
+
+
+def char_edit_distance(str_ref, str_hyp, ins_weight=1.0, del_weight=1.0, sub_weight=1.0, kernel='wavefront', alignment='list'):
+    """
+    Character-level str_edit_distance: the same DP and backtrace run on the codepoints of
+    the normalized strings, so that 'ihn'/'ihm' is one substitution instead of a whole
+    word. Returns (n_ins, n_del, n_sub, ref_len, alignment) with character counts and
+    indices into normalize_chars(str_ref) and normalize_chars(str_hyp).
+    """
+    if alignment not in ('list', 'ops', None):
+        raise ValueError("Unknown alignment format '{}'".format(alignment))
+    ref = codepoints(str_ref)
+    hyp = codepoints(str_hyp)
+    n_ins, n_del, n_sub, ops = _ids_edit_distance(ref, hyp, ins_weight, del_weight, sub_weight, kernel, alignment)
+    return (n_ins, n_del, n_sub, len(ref), ops)
+
+
+def batch_char_errors(refs, hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """
+    Per-pair number of character errors and reference lengths in characters. With unit
+    weights the bit-parallel algorithm runs on the normalized strings directly, which keeps
+    sentences 5-6 times longer than their word sequences cheap (one big-integer update per
+    hypothesis character); otherwise the codepoint arrays go through batch_edit_distance.
+    """
+    if len(refs) != len(hyps):
+        raise ValueError('Got {} references and {} hypotheses'.format(len(refs), len(hyps)))
+    refs = [normalize_chars(ref) for ref in refs]
+    hyps = [normalize_chars(hyp) for hyp in hyps]
+    if not _unit_weights(ins_weight, del_weight, sub_weight):
+        n_ins, n_del, n_sub, ref_lens, _ = batch_edit_distance([codepoints(ref) for ref in refs], [codepoints(hyp) for hyp in hyps], ins_weight, del_weight, sub_weight)
+        return n_ins + n_del + n_sub, ref_lens
+
+    errors = np.array([bit_parallel_distance(ref, hyp) for ref, hyp in zip(refs, hyps)], dtype=np.int64)
+    ref_lens = np.array([len(ref) for ref in refs], dtype=np.int64)
+    return errors, ref_lens
+
+
+def char_error_rate(refs, hyps, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    # Corpus-level CER: total character errors over total reference length in characters
+    errors, ref_lens = batch_char_errors(refs, hyps, ins_weight, del_weight, sub_weight)
+    return errors.sum() / ref_lens.sum() if ref_lens.sum() > 0 else float('nan')
+
+
+def _char_tiebroken_alignment(rtoks, htoks, ins_weight, del_weight, sub_weight):
+    """
+    Word alignment of minimal weighted cost that, among all the alignments of that cost,
+    has the fewest character errors (deleted and inserted tokens count their length,
+    substitutions their character edit distance). A second DP runs over the word-optimal
+    steps only, the ones whose weight accounts for the cell (checked in float32, as in
+    _backtrack). Returns the (ops, ref indices, hyp indices) lists in order.
+    """
+    interner = TokenInterner()
+    ref = np.asarray(interner.encode(rtoks), dtype=np.int64)
+    hyp = np.asarray(interner.encode(htoks), dtype=np.int64)
+    ed_matrix = _wavefront_ed_matrix(ref, hyp, ins_weight, del_weight, sub_weight).tolist()
+    n, m = len(rtoks), len(htoks)
+    f32 = np.float32
+    sub_chars = {}
+
+    def moves(i, j):
+        # (op, previous cell, character errors) of the word-optimal steps into (i, j)
+        cur = f32(ed_matrix[i][j])
+        if i > 0 and j > 0:
+            differs = rtoks[i-1] != htoks[j-1]
+            if cur == f32(ed_matrix[i-1][j-1]) + f32(sub_weight if differs else 0.0):
+                if differs and (i, j) not in sub_chars:
+                    n_ins, n_del, n_sub, _, _ = char_edit_distance(rtoks[i-1], htoks[j-1], ins_weight, del_weight, sub_weight, alignment=None)
+                    sub_chars[(i, j)] = n_ins + n_del + n_sub
+                yield (OP_SUB if differs else OP_MATCH), (i-1, j-1), (sub_chars[(i, j)] if differs else 0)
+        if i > 0 and (j == 0 or cur == f32(ed_matrix[i-1][j]) + f32(del_weight)):
+            yield OP_DEL, (i-1, j), len(rtoks[i-1])
+        if j > 0 and (i == 0 or cur == f32(ed_matrix[i][j-1]) + f32(ins_weight)):
+            yield OP_INS, (i, j-1), len(htoks[j-1])
+
+    char_errors = [[0] * (m+1) for _ in range(n+1)]
+    for i in range(n+1):
+        for j in range(m+1):
+            if i or j:
+                char_errors[i][j] = min(char_errors[pi][pj] + cost for _, (pi, pj), cost in moves(i, j))
+
+    ops, ref_indices, hyp_indices = [], [], []
+    i, j = n, m
+    while i or j:
+        # Match/substitution first, then deletion, then insertion, among the steps of fewest character errors
+        op, (pi, pj), _ = next(move for move in moves(i, j) if char_errors[move[1][0]][move[1][1]] + move[2] == char_errors[i][j])
+        ops.append(op)
+        ref_indices.append(i - 1)
+        hyp_indices.append(-1 if op == OP_DEL else j - 1)
+        i, j = pi, pj
+    return ops[::-1], ref_indices[::-1], hyp_indices[::-1]
+
+
+def token_char_alignment(str_ref, str_hyp, ref_span=None, ins_weight=1.0, del_weight=1.0, sub_weight=1.0):
+    """
+    Word alignment refined at the character level, for the reference tokens in
+    ref_span = (start, end) (e.g. a markable; default: the whole sentence). Insertions
+    next to the span are included. Among the word alignments of minimal cost, the one with
+    the fewest character errors is used, so that 'ihn' is paired with 'ihm' rather than
+    with an inserted neighbour. Returns (char_errors, ref_chars, steps): the character
+    errors and reference characters of the region, and one dict per word-alignment step
+    with its op, token indices and tokens, character errors and character alignment
+    (compact arrays, indices into the two tokens).
+    """
+    rtoks = str_ref.split()
+    htoks = str_hyp.split()
+    start, end = ref_span if ref_span is not None else (0, len(rtoks))
+    ops, ref_indices, hyp_indices = _char_tiebroken_alignment(rtoks, htoks, ins_weight, del_weight, sub_weight)
 
-    alignement.reverse()
-    return (n_ins, n_del, n_sub, curr_x_size, alignement)
+    steps = []
+    char_errors = 0
+    ref_chars = 0
+    for op, r, h in zip(ops, ref_indices, hyp_indices):
+        # An insertion sits after reference token r
+        if not (start <= r < end or (op == OP_INS and start - 1 <= r < end)):
+            continue
+        ref_token = rtoks[r] if op != OP_INS else ''
+        hyp_token = htoks[h] if op != OP_DEL else ''
+        if op == OP_MATCH:
+            n_errors = 0
+            char_ops = (np.zeros(len(ref_token), dtype=np.int8) + OP_MATCH, np.arange(len(ref_token), dtype=np.int32), np.arange(len(ref_token), dtype=np.int32))
+        else:
+            n_ins, n_del, n_sub, _, char_ops = char_edit_distance(ref_token, hyp_token, ins_weight, del_weight, sub_weight, alignment='ops')
+            n_errors = n_ins + n_del + n_sub
+        char_errors += n_errors
+        ref_chars += len(ref_token)
+        steps.append({
+            'op': OP_NAMES[op],
+            'ref_index': r if op != OP_INS else None,
+            'hyp_index': h if op != OP_DEL else None,
+            'ref': ref_token,
+            'hyp': hyp_token,
+            'char_errors': n_errors,
+            'char_alignment': char_ops,
+        })
+    return char_errors, ref_chars, steps
 
 
 def main(args):
@@ -107,7 +941,7 @@ def main(args):
     print(' * hyp: {}'.format(hyp_str))
     print(' ---')
 
-    er_vals = str_edit_distance(ref_str, hyp_str)
+    er_vals = str_edit_distance(ref_str, hyp_str, alignment='ops')
 
     print(' * ER: {:.2f}'.format(sum(er_vals[:3])/er_vals[3]))
     print(' * Errors:')
@@ -116,12 +950,9 @@ def main(args):
     print(' * sub: {}'.format(er_vals[2]))
     print(' ---')
 
-    rtoks = ref_str.split()
-    htoks = hyp_str.split()
-    alignement = er_vals[4]
     print( '* Alignement:' )
-    for t in alignement:
-        print(' * {}) r:{}, h:{}'.format(t[0], rtoks[t[1]], htoks[t[2]] if t[2] is not None else '-'))
+    for line in render_alignment(er_vals[4], ref_str.split(), hyp_str.split()):
+        print(' * {}'.format(line))
     print(' ---')
 
 
@@ -0,0 +1,282 @@
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+from edit_distance import SCLITE_WEIGHTS, str_edit_distance, batch_edit_distance, batch_word_errors, batch_banded_edit_distance, corpus_edit_distance, batch_char_errors, codepoints, bit_parallel_distance, multi_system_edit_distances
+
+
+def random_pair(n_tokens, vocabulary, error_rate=0.2, rng=random):
+    # A reference and a hypothesis obtained from it with random insertions, deletions and substitutions
+    ref = [rng.choice(vocabulary) for _ in range(n_tokens)]
+    hyp = []
+    for token in ref:
+        r = rng.random()
+        if r < error_rate / 3:
+            continue
+        elif r < 2 * error_rate / 3:
+            hyp.append(rng.choice(vocabulary))
+        elif r < error_rate:
+            hyp.extend([token, rng.choice(vocabulary)])
+        else:
+            hyp.append(token)
+    return ' '.join(ref), ' '.join(hyp)
+
+
+def weighted_distance(ref, hyp, ins_weight, del_weight, sub_weight):
+    # Plain float64 DP, independent of the kernels: the minimal weighted cost of the pair
+    ref = ref.split()
+    hyp = hyp.split()
+    prev = [j * ins_weight for j in range(len(hyp) + 1)]
+    for i, r in enumerate(ref, 1):
+        cur = [i * del_weight]
+        for j, h in enumerate(hyp, 1):
+            cur.append(min(prev[j] + del_weight, cur[j-1] + ins_weight, prev[j-1] + (0.0 if r == h else sub_weight)))
+        prev = cur
+    return prev[-1]
+
+
+def time_calls(function, pairs, repeat=3):
+    # Best of repeat runs, in seconds per pair
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for ref, hyp in pairs:
+            function(ref, hyp)
+        best = min(best, time.perf_counter() - start)
+    return best / len(pairs)
+
+
+def time_command(command, repeat=5):
+    # Best wall-clock time of a command run in a fresh interpreter, in seconds
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_startup(repeat=5):
+    """Wall-clock time of a CLI invocation of edit_distance.py, against the cost of importing torch."""
+    print(' * Startup time (best of {} runs)'.format(repeat))
+    python_time = time_command([sys.executable, '-c', 'pass'], repeat)
+    cli_time = time_command([sys.executable, 'edit_distance.py', 'the cat sat on the mat', 'a cat sat on mat'], repeat)
+    print(' * python -c pass: {:.3f}s'.format(python_time))
+    print(' * python edit_distance.py ref hyp: {:.3f}s'.format(cli_time))
+    try:
+        torch_time = time_command([sys.executable, '-c', 'import torch'], repeat)
+        print(' * python -c "import torch" (paid by every invocation before): {:.3f}s'.format(torch_time))
+    except subprocess.CalledProcessError:
+        print(' * torch is not installed')
+    print(' ---')
+
+
+def benchmark_kernels(lengths=(10, 30, 60, 120), n_pairs=20, seed=0):
+    """
+    Compare the loop and the wavefront kernels of str_edit_distance, and check that they
+    agree and that the weighted cost of their counts is the true weighted distance.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['w{}'.format(i) for i in range(50)]
+    print(' * Kernel benchmark (seconds per pair)')
+    print(' {:>8} {:>12} {:>12} {:>10}'.format('tokens', 'loop', 'wavefront', 'speed-up'))
+    for n_tokens in lengths:
+        pairs = [random_pair(n_tokens, vocabulary, rng=rng) for _ in range(n_pairs)]
+        for weights in [(1.0, 1.0, 1.0), (3.0, 3.0, 4.0)]:
+            for ref, hyp in pairs:
+                result = str_edit_distance(ref, hyp, *weights, kernel='wavefront')
+                assert str_edit_distance(ref, hyp, *weights, kernel='loop') == result
+                n_ins, n_del, n_sub = result[:3]
+                cost = n_ins * weights[0] + n_del * weights[1] + n_sub * weights[2]
+                assert math.isclose(cost, weighted_distance(ref, hyp, *weights))
+        # The loop kernel is very slow on long sentences, time it once
+        loop_time = time_calls(lambda r, h: str_edit_distance(r, h, kernel='loop'), pairs, repeat=1)
+        wavefront_time = time_calls(lambda r, h: str_edit_distance(r, h, kernel='wavefront'), pairs)
+        print(' {:>8} {:>12.6f} {:>12.6f} {:>9.1f}x'.format(n_tokens, loop_time, wavefront_time, loop_time / wavefront_time))
+    print(' ---')
+
+
+def benchmark_batch(n_pairs=2000, min_tokens=5, max_tokens=40, seed=0):
+    """Score a whole system output with one batch_edit_distance call against one str_edit_distance call per pair."""
+    rng = random.Random(seed)
+    vocabulary = ['w{}'.format(i) for i in range(50)]
+    pairs = [random_pair(rng.randint(min_tokens, max_tokens), vocabulary, rng=rng) for _ in range(n_pairs)]
+    refs = [ref for ref, _ in pairs]
+    hyps = [hyp for _, hyp in pairs]
+
+    start = time.perf_counter()
+    per_pair = [str_edit_distance(ref, hyp)[:3] for ref, hyp in pairs]
+    per_pair_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_ins, n_del, n_sub, _, _ = batch_edit_distance(refs, hyps)
+    batch_time = time.perf_counter() - start
+    assert per_pair == list(zip(n_ins.tolist(), n_del.tolist(), n_sub.tolist()))
+
+    print(' * Batched API ({} pairs, {}-{} tokens)'.format(n_pairs, min_tokens, max_tokens))
+    print(' * str_edit_distance per pair: {:.3f}s'.format(per_pair_time))
+    print(' * batch_edit_distance: {:.3f}s ({:.1f}x)'.format(batch_time, per_pair_time / batch_time))
+    print(' ---')
+
+
+def benchmark_word_errors(n_pairs=5000, min_tokens=5, max_tokens=120, seed=0):
+    """Unit-cost error counts: bit-parallel fast path against the batched DP."""
+    rng = random.Random(seed)
+    vocabulary = ['w{}'.format(i) for i in range(50)]
+    pairs = [random_pair(rng.randint(min_tokens, max_tokens), vocabulary, rng=rng) for _ in range(n_pairs)]
+    refs = [ref for ref, _ in pairs]
+    hyps = [hyp for _, hyp in pairs]
+
+    start = time.perf_counter()
+    n_ins, n_del, n_sub, _, _ = batch_edit_distance(refs, hyps)
+    dp_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    errors, _ = batch_word_errors(refs, hyps)
+    bit_parallel_time = time.perf_counter() - start
+    assert (errors == n_ins + n_del + n_sub).all()
+
+    print(' * Unit-cost error counts ({} pairs, {}-{} tokens)'.format(n_pairs, min_tokens, max_tokens))
+    print(' * batched DP: {:.3f}s'.format(dp_time))
+    print(' * bit-parallel: {:.3f}s ({:.1f}x)'.format(bit_parallel_time, dp_time / bit_parallel_time))
+    print(' ---')
+
+
+def benchmark_threads(n_pairs=8000, min_tokens=5, max_tokens=120, seed=0):
+    """corpus_edit_distance with 1 thread and with one thread per core."""
+    rng = random.Random(seed)
+    vocabulary = ['w{}'.format(i) for i in range(50)]
+    pairs = [random_pair(rng.randint(min_tokens, max_tokens), vocabulary, rng=rng) for _ in range(n_pairs)]
+    refs = [ref for ref, _ in pairs]
+    hyps = [hyp for _, hyp in pairs]
+
+    print(' * Corpus scoring over threads ({} pairs, {}-{} tokens, {} cores)'.format(n_pairs, min_tokens, max_tokens, os.cpu_count()))
+    single_time = None
+    for n_threads in sorted({1, os.cpu_count()}):
+        start = time.perf_counter()
+        corpus_edit_distance(refs, hyps, n_threads=n_threads)
+        elapsed = time.perf_counter() - start
+        single_time = single_time or elapsed
+        print(' * {} thread(s): {:.3f}s ({:.1f}x)'.format(n_threads, elapsed, single_time / elapsed))
+    print(' ---')
+
+
+def benchmark_chars(n_pairs=1000, min_tokens=5, max_tokens=40, seed=0):
+    """Character error counts: bit-parallel on strings against the batched DP on codepoint arrays."""
+    rng = random.Random(seed)
+    vocabulary = ['ihn', 'ihm', 'ihr', 'er', 'sie', 'es', 'il', 'elle', 'gesehen', 'Hund', 'Katze', 'dem', 'den', 'der']
+    pairs = [random_pair(rng.randint(min_tokens, max_tokens), vocabulary, rng=rng) for _ in range(n_pairs)]
+    refs = [ref for ref, _ in pairs]
+    hyps = [hyp for _, hyp in pairs]
+
+    start = time.perf_counter()
+    n_ins, n_del, n_sub, _, _ = batch_edit_distance([codepoints(ref) for ref in refs], [codepoints(hyp) for hyp in hyps])
+    dp_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    errors, ref_lens = batch_char_errors(refs, hyps)
+    bit_parallel_time = time.perf_counter() - start
+    assert (errors == n_ins + n_del + n_sub).all()
+
+    print(' * Character error counts ({} pairs, mean length {:.0f} characters)'.format(n_pairs, ref_lens.mean()))
+    print(' * batched DP: {:.3f}s'.format(dp_time))
+    print(' * bit-parallel: {:.3f}s ({:.1f}x)'.format(bit_parallel_time, dp_time / bit_parallel_time))
+    print(' ---')
+
+
+def benchmark_trie(n_refs=300, n_systems=8, min_tokens=10, max_tokens=60, seed=0):
+    """
+    Many systems against one reference: trie_edit_distances against one distance per
+    hypothesis. Synthetic systems share a prefix of a common output and diverge at a random point.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['w{}'.format(i) for i in range(50)]
+    refs = []
+    system_hyps = [[] for _ in range(n_systems)]
+    for _ in range(n_refs):
+        ref, shared = random_pair(rng.randint(min_tokens, max_tokens), vocabulary, rng=rng)
+        refs.append(ref)
+        shared = shared.split()
+        for hyps in system_hyps:
+            cut = rng.randint(len(shared) // 2, len(shared))
+            hyps.append(' '.join(shared[:cut] + random_pair(len(shared) - cut, vocabulary, rng=rng)[1].split()))
+
+    print(' * {} systems against one reference ({} references, {}-{} tokens)'.format(n_systems, n_refs, min_tokens, max_tokens))
+    for weights in [(1.0, 1.0, 1.0), (3.0, 3.0, 4.0)]:
+        start = time.perf_counter()
+        if weights == (1.0, 1.0, 1.0):
+            per_hyp = [[bit_parallel_distance(ref.split(), hyps[s].split()) for s, ref in enumerate(refs)] for hyps in system_hyps]
+        else:
+            per_hyp = [(lambda counts: counts[0] * weights[0] + counts[1] * weights[1] + counts[2] * weights[2])(batch_edit_distance(refs, hyps, *weights)).tolist() for hyps in system_hyps]
+        per_hyp_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distances = multi_system_edit_distances(refs, system_hyps, *weights)
+        trie_time = time.perf_counter() - start
+        print(' * weights {}: one call per hypothesis {:.3f}s, trie {:.3f}s ({:.1f}x)'.format(weights, per_hyp_time, trie_time, per_hyp_time / trie_time))
+        assert (distances == per_hyp).all()
+    print(' ---')
+
+
+def read_pairs(ref_file, hyp_file):
+    # Non-empty aligned lines of two files, e.g. DiscoMT references and system outputs
+    with open(ref_file, 'r') as file:
+        refs = file.read().splitlines()
+    with open(hyp_file, 'r') as file:
+        hyps = file.read().splitlines()
+    return [(ref, hyp) for ref, hyp in zip(refs, hyps) if ref.strip()]
+
+
+def benchmark_banded(pairs=None, thresholds=(2, 5, 10), n_pairs=500, min_tokens=60, max_tokens=150, seed=0):
+    """
+    Triage "which hypotheses are within k edits of the reference": banded DP against the
+    full batched DP. Without pairs, synthetic sentences of DiscoMT length are used.
+    """
+    if pairs is None:
+        rng = random.Random(seed)
+        vocabulary = ['w{}'.format(i) for i in range(50)]
+        pairs = [random_pair(rng.randint(min_tokens, max_tokens), vocabulary, error_rate=rng.choice([0.02, 0.1, 0.3]), rng=rng) for _ in range(n_pairs)]
+    refs = [ref for ref, _ in pairs]
+    hyps = [hyp for _, hyp in pairs]
+
+    start = time.perf_counter()
+    n_ins, n_del, n_sub, _, _ = batch_edit_distance(refs, hyps)
+    full_time = time.perf_counter() - start
+    errors = n_ins + n_del + n_sub
+
+    print(' * Banded edit distance ({} pairs, mean length {:.0f} tokens)'.format(len(pairs), sum(len(r.split()) for r in refs) / len(refs)))
+    print(' * full DP: {:.3f}s'.format(full_time))
+    for max_distance in thresholds:
+        start = time.perf_counter()
+        distances = batch_banded_edit_distance(refs, hyps, max_distance)
+        banded_time = time.perf_counter() - start
+        assert ((distances <= max_distance) == (errors <= max_distance)).all()
+        print(' * banded, k={:<3}: {:.3f}s ({:.1f}x), {} pairs within k'.format(max_distance, banded_time, full_time / banded_time, int((distances <= max_distance).sum())))
+
+    # Same triage with the sclite weights, whose borders and band width differ
+    n_ins, n_del, n_sub, _, _ = batch_edit_distance(refs, hyps, *SCLITE_WEIGHTS)
+    costs = n_ins * SCLITE_WEIGHTS[0] + n_del * SCLITE_WEIGHTS[1] + n_sub * SCLITE_WEIGHTS[2]
+    for max_distance in thresholds:
+        distances = batch_banded_edit_distance(refs, hyps, 3 * max_distance, *SCLITE_WEIGHTS)
+        assert ((distances <= 3 * max_distance) == (costs <= 3 * max_distance)).all()
+        assert (distances[costs <= 3 * max_distance] == costs[costs <= 3 * max_distance]).all()
+    print(' ---')
+
+
+def main(args):
+    benchmark_startup()
+    benchmark_kernels()
+    benchmark_batch()
+    benchmark_word_errors()
+    benchmark_threads()
+    benchmark_chars()
+    benchmark_trie()
+    # Optional reference and hypothesis files for the banded benchmark
+    benchmark_banded(read_pairs(args[1], args[2]) if len(args) > 2 else None)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,216 @@
+import functools
+import re
+import string
+import threading
+import bert_score
+import nltk
+import pandas as pd
+import torch
+from bert_score import BERTScorer
+from bert_score.utils import lang2model, model2layers
+from nltk.translate.bleu_score import SmoothingFunction, sentence_bleu
+
+from bert_embedding_cache import ReferenceEmbeddingCache
+from edit_distance import render_alignment, str_edit_distance
+
+
+# Contractions expanded by tokenize_and_remove_punctuation
+CONTRACTIONS = {
+    r"\bcan't\b": "cannot",
+    r"\bhaven't\b": "have not",
+    r"\bdon't\b": "do not",
+    r"\bthat's\b": "that is",
+    r"\bdoesn't\b": "does not",
+    r"\bit's\b": "it is",
+    r"\bi'm\b": "i am",
+    r"\bwe're\b": "we are",
+    r"\byou're\b": "you are",
+    r"\bthey're\b": "they are",
+    r"\bdidn't\b": "did not",
+    r"\bwasn't\b": "was not",
+    r"\bwon't\b": "will not",
+    r"\bwouldn't\b": "would not",
+    r"\bshouldn't\b": "should not",
+    r"\bcouldn't\b": "could not",
+    r"\baren't\b": "are not",
+    r"\bdaren't\b": "dare not",
+    r"\bneedn't\b": "need not",
+    # Add more contractions and their expansions as needed
+}
+
+
+# Function to tokenize and remove punctuation and handle contractions
+def tokenize_and_remove_punctuation(text, expand_contractions=True):
+    if pd.notna(text):
+        cleaned_text = str(text)
+        cleaned_text = re.sub(r"\bquot\b|-", "", cleaned_text)
+
+        # Handle contractions
+        if expand_contractions:
+            for contraction, expansion in CONTRACTIONS.items():
+                cleaned_text = re.sub(contraction, expansion, cleaned_text)
+
+        tokens = cleaned_text.split()
+        tokens = [token.strip(string.punctuation) for token in tokens]
+        tokens = [token for token in tokens if token]
+
+        cleaned_text = ' '.join(tokens)
+
+        return cleaned_text
+    else:
+        return ""
+
+
+def _cached_scores(cache, refs, hyps, metric, config, score_fn):
+    # Without a cache every pair is scored
+    if cache is None:
+        return score_fn(refs, hyps)
+    return cache.score(refs, hyps, metric, config, score_fn)
+
+
+def _edit_distance_scores(refs, hyps):
+    # Counts and compact alignment of each pair, as JSON-friendly lists
+    scores = []
+    for ref, hyp in zip(refs, hyps):
+        n_ins, n_del, n_sub, ref_len, (ops, ref_indices, hyp_indices) = str_edit_distance(ref, hyp, alignment='ops')
+        scores.append([n_ins, n_del, n_sub, ref_len, ops.tolist(), ref_indices.tolist(), hyp_indices.tolist()])
+    return scores
+
+
+def _bleu_scores(refs, hyps):
+    # Create a SmoothingFunction instance
+    smooth_func = SmoothingFunction()
+    return [sentence_bleu([nltk.word_tokenize(ref)], nltk.word_tokenize(hyp), smoothing_function=smooth_func.method1) for ref, hyp in zip(refs, hyps)]
+
+
+class BERTScorerRegistry:
+    """
+    Process-level cache of BERTScorer instances, keyed by (model type, language, layer,
+    rescale_with_baseline). Each scorer (model weights and baseline file) is built on first
+    use and reused by every later compute_metrics call, for every system, together with
+    the on-disk cache of its reference embeddings.
+    """
+
+    def __init__(self):
+        self._scorers = {}   # (model_type, lang, num_layers, rescale_with_baseline) -> BERTScorer
+        self._references = {}   # same key -> ReferenceEmbeddingCache
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_type=None, lang="en", num_layers=None, rescale_with_baseline=True):
+        # Resolve bert_score's defaults, so that implicit and explicit settings share an entry
+        lang = lang.lower() if lang else None
+        model_type = model_type or lang2model[lang]
+        num_layers = num_layers if num_layers is not None else model2layers[model_type]
+        return (model_type, lang, num_layers, rescale_with_baseline)
+
+    def get(self, model_type=None, lang="en", num_layers=None, rescale_with_baseline=True):
+        key = self.key(model_type, lang, num_layers, rescale_with_baseline)
+        with self._lock:
+            if key not in self._scorers:
+                self._scorers[key] = BERTScorer(model_type=key[0], lang=key[1], num_layers=key[2], rescale_with_baseline=key[3])
+            return self._scorers[key]
+
+    def references(self, model_type=None, lang="en", num_layers=None, rescale_with_baseline=True):
+        """ReferenceEmbeddingCache of the scorer with these settings."""
+        scorer = self.get(model_type, lang, num_layers, rescale_with_baseline)
+        key = self.key(model_type, lang, num_layers, rescale_with_baseline)
+        with self._lock:
+            if key not in self._references:
+                self._references[key] = ReferenceEmbeddingCache(scorer)
+            return self._references[key]
+
+    def release(self, model_type=None, lang="en", num_layers=None, rescale_with_baseline=True, all_scorers=False):
+        """Drop one scorer (or every scorer with all_scorers=True) and free the GPU memory it held."""
+        with self._lock:
+            if all_scorers:
+                self._scorers.clear()
+                self._references.clear()
+            else:
+                key = self.key(model_type, lang, num_layers, rescale_with_baseline)
+                self._scorers.pop(key, None)
+                self._references.pop(key, None)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def __contains__(self, key):
+        return key in self._scorers
+
+
+# Scorers shared by all the compute_metrics calls of the process
+bert_scorers = BERTScorerRegistry()
+
+
+def _bert_scores(refs, hyps, batch_size=64):
+    # The BERTScore model is only loaded when some pairs are not cached, and then stays loaded
+    references = bert_scorers.references(lang="en", rescale_with_baseline=True)
+    # References missing from the embedding cache are embedded once, into a single shard
+    references.add(refs, batch_size)
+    # Pairs of similar length share a batch, so that little of each forward pass is padding
+    order = sorted(range(len(refs)), key=lambda i: -max(len(refs[i].split()), len(hyps[i].split())))
+    scores = [0.0] * len(refs)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        _, _, f1 = references.score([hyps[i] for i in batch], [refs[i] for i in batch], batch_size=batch_size)
+        # Scatter the scores back to the rows of the batch
+        for i, score in zip(batch, f1.tolist()):
+            scores[i] = score
+        print(f"BERTScore: {start + len(batch)}/{len(order)} pairs", end="\r" if start + len(batch) < len(order) else "\n")
+    return scores
+
+
+# Metric configurations, part of the score cache keys
+EDIT_DISTANCE_CONFIG = {"weights": [1.0, 1.0, 1.0]}
+BLEU_CONFIG = {"tokenizer": "nltk.word_tokenize", "smoothing": "method1", "nltk": nltk.__version__}
+BERT_SCORE_CONFIG = {"lang": "en", "rescale_with_baseline": True, "score": "F1", "bert_score": bert_score.__version__, "embeddings": "float16"}
+
+
+# Function to compute metrics and print results
+def compute_metrics(ref_column, hyp_column, data_prefix, cache=None, expand_contractions=True, bert_batch_size=64):
+    """
+    Edit distance, sentence BLEU and BERTScore F1 of every (reference, hypothesis) row,
+    on the cleaned sentences. With a ScoreCache, only the pairs that were never scored
+    with the same metric configuration reach the scorers. BERTScore runs on all the
+    pairs at once, in length-sorted batches of bert_batch_size pairs.
+    """
+    cleaned_refs = [tokenize_and_remove_punctuation(str(ref_str).strip(), expand_contractions).strip() for ref_str in ref_column]
+    cleaned_hyps = [tokenize_and_remove_punctuation(str(hyp_str).strip(), expand_contractions) for hyp_str in hyp_column]
+
+    er_scores = _cached_scores(cache, cleaned_refs, cleaned_hyps, "edit_distance", EDIT_DISTANCE_CONFIG, _edit_distance_scores)
+    bleu_scores = _cached_scores(cache, cleaned_refs, cleaned_hyps, "sentence_bleu", BLEU_CONFIG, _bleu_scores)
+    bert_scores = _cached_scores(cache, cleaned_refs, cleaned_hyps, "bert_score", BERT_SCORE_CONFIG, functools.partial(_bert_scores, batch_size=bert_batch_size))
+
+    edit_distances = []
+    for cleaned_ref, cleaned_hyp, er_vals in zip(cleaned_refs, cleaned_hyps, er_scores):
+        if er_vals[3] == 0:
+            edit_distances.append(float('nan'))
+            print(f'{data_prefix} - Reference:', cleaned_ref)
+            print(f'{data_prefix} - Hypothesis:', cleaned_hyp)
+            print('---')
+            print(f'{data_prefix} - Hyp File:', cleaned_hyp)
+            print(f'{data_prefix} - Error rate: N/A (Reference length is zero)')
+            print('---')
+            continue
+        edit_distances.append(sum(er_vals[:3]) / er_vals[3])
+
+        print(f'{data_prefix} - Computing edit distance between:')
+        print(f'{data_prefix} - ref: {cleaned_ref}')
+        print(f'{data_prefix} - hyp: {cleaned_hyp}')
+        print(' ---')
+
+        print(f'{data_prefix} - ER: {sum(er_vals[:3])/er_vals[3]:.2f}')
+        print(f'{data_prefix} - Errors:')
+        print(f'{data_prefix} - ins: {er_vals[0]}')
+        print(f'{data_prefix} - del: {er_vals[1]}')
+        print(f'{data_prefix} - sub: {er_vals[2]}')
+        print(' ---')
+
+        print(f'{data_prefix} - Alignment:')
+        alignment = tuple(er_vals[4:7])
+        for line in render_alignment(alignment, cleaned_ref.split(), cleaned_hyp.split()):
+            print(f'{data_prefix} - {line}')
+        print(' ---')
+
+    if cache is not None:
+        print(cache.report())
+    return edit_distances, bleu_scores, bert_scores
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+
+from translation_cache import SQLiteStore, normalize_source
+
+
+# Default location of the score cache shared by the notebooks
+SCORE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ca-nmt", "scores.sqlite")
+
+
+def score_key(ref, hyp, metric, config):
+    """
+    Content address of one score: hash of the normalized reference and hypothesis, the
+    metric name and everything in config that changes its value (tokenizer, weights,
+    model, library version...).
+    """
+    payload = json.dumps({"ref": normalize_source(ref), "hyp": normalize_source(hyp), "metric": metric, "config": config}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ScoreCache:
+    """
+    Disk-backed (SQLite) per-pair score cache, shared by all the metrics. A value is
+    any JSON-serializable score (a float, a list of counts...).
+
+        cache = ScoreCache("scores.sqlite")
+        scores = cache.score(refs, hyps, "sentence_bleu", config, score_fn)
+
+    Only the pairs missing from the cache are passed to score_fn, each distinct pair once.
+    """
+
+    def __init__(self, path=SCORE_CACHE_PATH):
+        self.path = path
+        self._store = SQLiteStore(
+            path,
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "key TEXT PRIMARY KEY, metric TEXT NOT NULL, value TEXT NOT NULL)",
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys found in the cache."""
+        rows = self._store.select_in("SELECT key, value FROM scores WHERE key IN ({})", keys)
+        return {key: json.loads(value) for key, value in rows}
+
+    def put_many(self, items, metric):
+        """Store (key, value) pairs of one metric."""
+        self._store.executemany(
+            "INSERT OR REPLACE INTO scores (key, metric, value) VALUES (?, ?, ?)",
+            [(key, metric, json.dumps(value)) for key, value in items],
+        )
+
+    def score(self, refs, hyps, metric, config, score_fn):
+        """
+        Scores of every (ref, hyp) pair. score_fn(refs, hyps) is called once with the
+        distinct missing pairs, so that the caller can batch them, and returns their scores.
+        """
+        keys = [score_key(ref, hyp, metric, config) for ref, hyp in zip(refs, hyps)]
+        found = self.get_many(keys)
+
+        missing = {}
+        for key, ref, hyp in zip(keys, refs, hyps):
+            if key not in found and key not in missing:
+                missing[key] = (ref, hyp)
+        if missing:
+            scores = score_fn([ref for ref, _ in missing.values()], [hyp for _, hyp in missing.values()])
+            new_items = list(zip(missing, scores))
+            self.put_many(new_items, metric)
+            # Read back through JSON, so that hits and misses return the same types
+            found.update((key, json.loads(json.dumps(value))) for key, value in new_items)
+
+        n_misses = sum(1 for key in keys if key in missing)
+        self.misses += n_misses
+        self.hits += len(keys) - n_misses
+        return [found[key] for key in keys]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        return f"Score cache: {self.hits} hits, {self.misses} misses (hit rate {100 * self.hit_rate():.1f}%)"
+
+    def purge(self, metrics=None):
+        """Delete the entries of the given metrics (default: all of them)."""
+        if metrics is None:
+            self._store.execute("DELETE FROM scores")
+        else:
+            metrics = list(metrics)
+            query = "DELETE FROM scores WHERE metric IN ({})".format(",".join("?" * len(metrics)))
+            self._store.execute(query, metrics)
+
+    def close(self):
+        self._store.close()
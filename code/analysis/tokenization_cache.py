@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+
+# Tokenized files are cached here, one directory per (tokenizer, file content) pair
+TOKENIZATION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ca-nmt", "tokenized")
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def tokenizer_hash(tokenizer, max_length=512):
+    """Hash of everything that changes the token ids produced by the tokenizer."""
+    sha = hashlib.sha256()
+    sha.update(type(tokenizer).__name__.encode("utf-8"))
+    sha.update(str(max_length).encode("utf-8"))
+    sha.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    # Marian tokenizers segment with a SentencePiece model that is not part of the vocabulary
+    spm_source = getattr(tokenizer, "spm_source", None)
+    if spm_source is not None:
+        sha.update(spm_source.serialized_model_proto())
+    return sha.hexdigest()
+
+
+class TokenizedFile:
+    """
+    Token ids of every line of a text file: a flat int32 memmap plus per-line offsets
+    and lengths. Line i is ids[offsets[i]:offsets[i] + lengths[i]].
+    """
+
+    def __init__(self, directory):
+        ids_file = os.path.join(directory, "ids.int32")
+        # np.memmap cannot map an empty file
+        self.ids = np.memmap(ids_file, dtype=np.int32, mode="r") if os.path.getsize(ids_file) else np.zeros(0, dtype=np.int32)
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.lengths = np.load(os.path.join(directory, "lengths.npy"))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def line_ids(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i] + self.lengths[i]]
+
+    def padded_batch(self, indices, pad_id):
+        """(input_ids, attention_mask) arrays for the given lines, right-padded with pad_id."""
+        longest = int(self.lengths[indices].max()) if len(indices) else 0
+        input_ids = np.full((len(indices), longest), pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(indices), longest), dtype=np.int64)
+        for row, i in enumerate(indices):
+            length = self.lengths[i]
+            input_ids[row, :length] = self.line_ids(i)
+            attention_mask[row, :length] = 1
+        return input_ids, attention_mask
+
+
+def tokenize_file(input_file, tokenizer, max_length=512, cache_dir=None):
+    """
+    Return the TokenizedFile of input_file, tokenizing it only if no cached version exists
+    for this tokenizer and this exact file content.
+    """
+    key = "{}-{}".format(tokenizer_hash(tokenizer, max_length)[:16], file_hash(input_file)[:16])
+    directory = os.path.join(cache_dir or TOKENIZATION_CACHE_DIR, key)
+    if os.path.exists(os.path.join(directory, "lengths.npy")):
+        return TokenizedFile(directory)
+
+    with open(input_file, "r") as file:
+        lines = file.read().splitlines()
+    id_lists = tokenizer(lines, max_length=max_length, truncation=True)["input_ids"] if lines else []
+    lengths = np.array([len(ids) for ids in id_lists], dtype=np.int32)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    if len(lengths):
+        offsets[1:] = np.cumsum(lengths[:-1], dtype=np.int64)
+
+    # Build in a temporary directory and rename it, so that an interrupted run leaves no partial entry
+    tmp_directory = directory + ".tmp{}".format(os.getpid())
+    os.makedirs(tmp_directory, exist_ok=True)
+    np.fromiter((token for ids in id_lists for token in ids), dtype=np.int32, count=int(lengths.sum())).tofile(os.path.join(tmp_directory, "ids.int32"))
+    np.save(os.path.join(tmp_directory, "offsets.npy"), offsets)
+    # lengths.npy is written last, its presence marks a complete entry
+    np.save(os.path.join(tmp_directory, "lengths.npy"), lengths)
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # Another process built the same entry in the meantime
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return TokenizedFile(directory)
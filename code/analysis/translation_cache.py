@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import unicodedata
+
+
+def normalize_source(sentence):
+    """
+    Normalization applied to a source sentence before it is used as a cache key:
+    NFC unicode form and collapsed whitespace.
+    """
+    return " ".join(unicodedata.normalize("NFC", sentence).split())
+
+
+def cache_namespace(model_id, generation_config):
+    """
+    Hash of everything, apart from the source sentence, that determines a translation.
+    Changing the model or any decoding parameter gives a new namespace, so old
+    entries are never returned for the new setting.
+    """
+    payload = json.dumps({"model": model_id, "generation": generation_config}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SQLiteStore:
+    """
+    One SQLite file shared by the threads of a process, used by the translation and
+    score caches. The connection is shared between threads, access is serialized by the lock.
+    """
+
+    # Stay well below SQLite's limit on the number of query parameters
+    CHUNK_SIZE = 500
+
+    def __init__(self, path, schema):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.execute(schema)
+
+    def select_in(self, query, values, params=()):
+        """
+        Rows of query for every value, run in chunks. query holds one {} placeholder for the
+        "?, ?, ..." list of an IN clause; params are bound before the chunk of values.
+        """
+        rows = []
+        values = list(dict.fromkeys(values))
+        with self._lock:
+            for start in range(0, len(values), self.CHUNK_SIZE):
+                chunk = values[start:start + self.CHUNK_SIZE]
+                rows.extend(self._connection.execute(query.format(",".join("?" * len(chunk))), list(params) + chunk).fetchall())
+        return rows
+
+    def execute(self, query, params=()):
+        with self._lock, self._connection:
+            self._connection.execute(query, params)
+
+    def executemany(self, query, rows):
+        with self._lock, self._connection:
+            self._connection.executemany(query, rows)
+
+    def close(self):
+        self._connection.close()
+
+
+class TranslationCache:
+    """
+    Disk-backed translation memory (SQLite), keyed on
+    (model id, generation config, normalized source sentence).
+
+        cache = TranslationCache("translations.sqlite")
+        translations = cache.translate(sentences, translate_fn, model_id, generation_config)
+
+    Only the cache misses are passed to translate_fn, each distinct sentence once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._store = SQLiteStore(
+            path,
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "namespace TEXT NOT NULL, source TEXT NOT NULL, translation TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, source))",
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, sources, namespace):
+        """Return {normalized source: translation} for the sources found in the cache."""
+        query = "SELECT source, translation FROM translations WHERE namespace = ? AND source IN ({})"
+        return dict(self._store.select_in(query, sources, [namespace]))
+
+    def put_many(self, pairs, namespace):
+        """Store (normalized source, translation) pairs."""
+        self._store.executemany(
+            "INSERT OR REPLACE INTO translations (namespace, source, translation) VALUES (?, ?, ?)",
+            [(namespace, source, translation) for source, translation in pairs],
+        )
+
+    def translate(self, sentences, translate_fn, model_id, generation_config):
+        namespace = cache_namespace(model_id, generation_config)
+        normalized = [normalize_source(sentence) for sentence in sentences]
+        found = self.get_many(normalized, namespace)
+
+        # Translate every distinct missing sentence once, in a single call so that the caller can batch them
+        missing = [source for source in dict.fromkeys(normalized) if source not in found]
+        if missing:
+            translated = translate_fn(missing)
+            new_pairs = list(zip(missing, translated))
+            self.put_many(new_pairs, namespace)
+            found.update(new_pairs)
+
+        missing = set(missing)
+        n_misses = sum(1 for source in normalized if source in missing)
+        self.misses += n_misses
+        self.hits += len(sentences) - n_misses
+        return [found[source] for source in normalized]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        return f"Translation cache: {self.hits} hits, {self.misses} misses (hit rate {100 * self.hit_rate():.1f}%)"
+
+    def purge(self, keep_namespaces=()):
+        """Delete every entry whose namespace is not in keep_namespaces, e.g. after a model update."""
+        keep_namespaces = list(keep_namespaces)
+        query = "DELETE FROM translations WHERE namespace NOT IN ({})".format(",".join("?" * len(keep_namespaces)))
+        self._store.execute(query, keep_namespaces)
+
+    def close(self):
+        self._store.close()
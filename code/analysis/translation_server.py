@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from baseline import load_model, translate_batch
+
+
+class DynamicBatcher:
+    """
+    Coalesces concurrent translation requests into batches.
+
+    A batch is sent to the model as soon as it holds max_batch_tokens source tokens,
+    or when its oldest sentence has waited max_wait_ms since it was queued. Sentences
+    already queued are always taken without waiting, up to the token budget. Generation
+    runs in a single worker thread so the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, model_name, max_batch_tokens=4096, max_wait_ms=20, num_beams=None):
+        self.model_name = model_name
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.num_beams = num_beams
+        self.tokenizer, self.model = load_model(model_name)
+        self._queue = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # Metrics exposed by the "metrics" request
+        self.n_requests = 0
+        self.n_sentences = 0
+        self.n_batches = 0
+        # Only the most recent batches are kept, so that a long-running server does not grow
+        self.batch_sizes = deque(maxlen=1000)
+        self.batch_latencies = deque(maxlen=1000)
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def translate(self, sentences):
+        """Queue sentences and wait for their translations."""
+        loop = asyncio.get_running_loop()
+        futures = []
+        for sentence in sentences:
+            future = loop.create_future()
+            n_tokens = len(self.tokenizer(sentence, max_length=512, truncation=True)["input_ids"])
+            await self._queue.put((sentence, n_tokens, future, loop.time()))
+            futures.append(future)
+        self.n_requests += 1
+        return await asyncio.gather(*futures)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        pending = None
+        while True:
+            # Wait for the first sentence of the next batch
+            first = pending if pending is not None else await self._queue.get()
+            pending = None
+            batch = [first]
+            longest = first[1]
+            # The queue is FIFO, so the first sentence is the oldest one of the batch
+            deadline = first[3] + self.max_wait
+
+            # Gather more sentences until the wait time or the token budget is reached
+            while True:
+                if not self._queue.empty():
+                    item = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                # Padded size of the batch if the sentence is added
+                if (len(batch) + 1) * max(longest, item[1]) > self.max_batch_tokens:
+                    pending = item
+                    break
+                batch.append(item)
+                longest = max(longest, item[1])
+
+            sentences = [sentence for sentence, _, _, _ in batch]
+            start = time.perf_counter()
+            try:
+                translations = await loop.run_in_executor(self._executor, translate_batch, sentences, self.tokenizer, self.model, 512, self.num_beams)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batch_latencies.append(time.perf_counter() - start)
+            self.batch_sizes.append(len(batch))
+            self.n_batches += 1
+            self.n_sentences += len(batch)
+            for (_, _, future, _), translation in zip(batch, translations):
+                if not future.done():
+                    future.set_result(translation)
+
+    def metrics(self):
+        recent_sizes = list(self.batch_sizes)
+        recent_latencies = list(self.batch_latencies)
+        return {
+            "model_name": self.model_name,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "requests": self.n_requests,
+            "sentences": self.n_sentences,
+            "batches": self.n_batches,
+            "mean_batch_size": sum(recent_sizes) / len(recent_sizes) if recent_sizes else 0,
+            "max_batch_size": max(recent_sizes, default=0),
+            "mean_batch_latency": sum(recent_latencies) / len(recent_latencies) if recent_latencies else 0,
+        }
+
+
+async def handle_client(reader, writer, batcher):
+    """
+    Line-delimited JSON protocol, one request per line:
+        {"sentences": ["..."]}   ->  {"translations": ["..."]}
+        {"metrics": true}        ->  {"metrics": {...}}
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if request.get("metrics"):
+                    response = {"metrics": batcher.metrics()}
+                else:
+                    response = {"translations": await batcher.translate(request["sentences"])}
+            except Exception as e:
+                response = {"error": repr(e)}
+            writer.write((json.dumps(response) + "\n").encode("utf-8"))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(model_name, socket_path=None, host="127.0.0.1", port=8765, max_batch_tokens=4096, max_wait_ms=20, num_beams=None):
+    batcher = DynamicBatcher(model_name, max_batch_tokens=max_batch_tokens, max_wait_ms=max_wait_ms, num_beams=num_beams)
+    await batcher.start()
+
+    async def handler(reader, writer):
+        await handle_client(reader, writer, batcher)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(handler, path=socket_path)
+        print(f"Translation server for '{model_name}' listening on {socket_path}")
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        print(f"Translation server for '{model_name}' listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+class TranslationClient:
+    """
+    Blocking client for notebooks and scripts:
+
+        client = TranslationClient(socket_path="/tmp/ca-nmt-translate.sock")
+        translations = client.translate(["The cat sat on the mat."])
+    """
+
+    def __init__(self, socket_path=None, host="127.0.0.1", port=8765):
+        import socket
+        if socket_path:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(socket_path)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile("rwb")
+
+    def _request(self, request):
+        self._file.write((json.dumps(request) + "\n").encode("utf-8"))
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def translate(self, sentences):
+        return self._request({"sentences": list(sentences)})["translations"]
+
+    def metrics(self):
+        return self._request({"metrics": True})["metrics"]
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local translation service with dynamic batching, built on the baseline model.")
+    parser.add_argument("--model_name", default="Helsinki-NLP/opus-mt-en-de")
+    parser.add_argument("--socket", default=None, help="Unix socket path (default: TCP on --host/--port)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="Maximum padded source tokens per batch")
+    parser.add_argument("--max_wait_ms", type=float, default=20, help="Maximum time a sentence waits for its batch to fill")
+    parser.add_argument("--beams", type=int, default=None, help="Beam size (default: the model's generation config)")
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.model_name, args.socket, args.host, args.port, args.max_batch_tokens, args.max_wait_ms, args.beams))
+
+
+if __name__ == "__main__":
+    main()